@@ -1,13 +1,25 @@
 # bot/handlers.py
+import asyncio
 import logging
+import os
 import re
+import tempfile
+import time
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import ContextTypes, filters
-from database.db import init_db, add_user, get_user, get_all_users, remove_user, add_product, get_product, load_products
-from services.wildberries_api import get_orders, fetch_product_info, get_sales_report, get_orders_in_transit, get_stock_data, get_product_cards
-from utils.messages import orders_message, sales_report_message, generate_sales_excel
-from config.config import BOT_KEY
-from services.barcode_gen import generate_barcode
+from database.db import init_db, add_user, get_user, get_all_users, remove_user, add_product, get_product, \
+    run_db
+from services.wildberries_api import get_orders, WBApiError
+from utils.messages import orders_message
+from config.config import BOT_KEY, COST_IMPORT_PROGRESS_INTERVAL, COST_IMPORT_ERRORS_SHOWN
+from services.barcode_gen import generate_barcode, generate_label_sheet
+from services.notifications import build_order_info
+from services.catalog import get_product_details
+from services.catalog_sync import sync_catalog
+from services.cost_import import import_costs, CostImportError
+from services.report_renderer import ReportQueueFull
+from services.report_cache import report_cache
+from services.reports import get_user_report
 
 logging.basicConfig(
     level=logging.INFO,
@@ -30,7 +42,7 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Используйте: /register <wb_token> <chat_id>")
         return
     wb_token, chat_id = args[0], args[1]
-    add_user(user_id, username, wb_token, chat_id)
+    await run_db(add_user, user_id, username, wb_token, chat_id)
     await update.message.reply_text("Вы успешно зарегистрированы!")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -38,13 +50,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/start - Начать\n"
         "/register <wb_token> <chat_id> - Зарегистрироваться\n"
         "/check_orders - Проверить заказы\n"
+        "/labels - Все этикетки новых заказов одним PDF\n"
         "/help - Помощь"
     )
     await update.message.reply_text(help_text)
 
 async def check_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    user = get_user(user_id)
+    user = await run_db(get_user, user_id)
     if not user:
         await update.message.reply_text("Пожалуйста, зарегистрируйтесь с помощью /register.")
         return
@@ -56,9 +69,34 @@ async def check_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.message.reply_text("Ошибка при получении заказов.")
 
 
+async def labels_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отправляет этикетки всех текущих новых заказов одним многостраничным PDF."""
+    user_id = update.message.from_user.id
+    user = await run_db(get_user, user_id)
+    if not user:
+        await update.message.reply_text("Пожалуйста, зарегистрируйтесь с помощью /register.")
+        return
+    try:
+        orders = await get_orders(user['wb_token'])
+        if not orders:
+            await update.message.reply_text("Нет новых заказов.")
+            return
+        infos = await asyncio.gather(*(build_order_info(order['id'], order, user['wb_token'], user_id)
+                                       for order in orders))
+        pdf_data, pages = await generate_label_sheet([info['label'] for info in infos])
+        if not pdf_data:
+            await update.message.reply_text("Не удалось сгенерировать этикетки.")
+            return
+        await context.bot.send_document(chat_id=update.effective_chat.id, document=pdf_data,
+                                        filename=f'labels_{pages}.pdf', caption=f"Этикетки с баркодом: {pages} шт.")
+    except Exception as e:
+        logging.error(f"Error while generating labels: {e}", exc_info=True)
+        await update.message.reply_text("Ошибка при генерации этикеток.")
+
+
 async def sales_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    user = get_user(user_id)
+    user = await run_db(get_user, user_id)
     if not user:
         await update.message.reply_text("Пожалуйста, зарегистрируйтесь с помощью /register.")
         return
@@ -70,30 +108,26 @@ async def sales_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
     date_from, date_to = args[0], args[1]
     try:
-        sales_data = await get_sales_report(date_from, date_to, user['wb_token'])
-        stock_data = await get_stock_data(date_from, user['wb_token'])
-        transit_data = await get_orders_in_transit(user['wb_token'])
-
-        result = generate_sales_excel(sales_data, stock_data, transit_data, date_from, date_to,
-                                      user_id)  # Передаём user_id
-        if result is None:
+        try:
+            report = await get_user_report(user, date_from, date_to)
+        except ReportQueueFull:
+            await update.message.reply_text("Сейчас строится много отчётов, попробуйте через минуту.")
+            return
+        if report is None:
             await update.message.reply_text("Не удалось сгенерировать отчёт из-за отсутствия данных.")
             return
 
-        excel_file, metrics = result
-        text, _ = sales_report_message(metrics, user_id)
-
-        await update.message.reply_text(text)
-        if excel_file:
-            with open(excel_file, 'rb') as f:
-                await context.bot.send_document(chat_id=update.effective_chat.id, document=f, filename=excel_file)
+        await update.message.reply_text(report['text'])
+        if report['excel']:
+            await context.bot.send_document(chat_id=update.effective_chat.id, document=report['excel'],
+                                            filename=report['excel_name'])
     except Exception as e:
         logging.error(f"Error fetching sales report: {e}")
         await update.message.reply_text("Ошибка при получении отчета по продажам.")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    user = get_user(user_id)
+    user = await run_db(get_user, user_id)
     if not user:
         await update.message.reply_text("Пожалуйста, зарегистрируйтесь с помощью /register.")
         return
@@ -105,14 +139,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     else:
         article = re.search(r'артикул:\s*(\w+)', text, re.IGNORECASE)
         if article:
-            product_info = await fetch_product_info(article.group(1), user['wb_token'])
-            if product_info and product_info['cards']:
-                product = product_info['cards'][0]
-                title = product.get('title', 'Не указано')
-                vendor_code = product.get('vendorCode', 'Не указано')
-                brand = product.get('brand', 'Не указано')
-                sku = product.get('sizes', [])[0].get('skus', [''])[0]
-                size = product.get('sizes', [])[0].get('wbSize', 'Не указано')
+            product_info = await get_product_details(user_id, user['wb_token'], article.group(1))
+            if product_info and product_info['sizes']:
+                title = product_info['title'] or 'Не указано'
+                vendor_code = product_info['vendor_code'] or 'Не указано'
+                brand = product_info['brand'] or 'Не указано'
+                sku = product_info['sizes'][0]['sku']
+                size = product_info['sizes'][0]['wbSize'] or 'Не указано'
                 pdf_data = await generate_barcode(sku, title, vendor_code, brand, size)
                 response = f"Товар:\nНазвание: {title}\nБренд: {brand}\nАртикул: {vendor_code}\n"
                 await update.message.reply_text(response)
@@ -126,7 +159,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def add_product_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    user = get_user(user_id)
+    user = await run_db(get_user, user_id)
     if not user:
         await update.message.reply_text("Пожалуйста, зарегистрируйтесь с помощью /register.")
         return
@@ -140,11 +173,12 @@ async def add_product_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     cost = args[1]
     try:
         purchase_cost = float(cost)
-        current_product = get_product(user_id, article)
+        current_product = await run_db(get_product, user_id, article)
         name = current_product.get('name', article) if current_product else article
         nmID = current_product.get('nmID') if current_product else None
         category = current_product.get('category') if current_product else None
-        add_product(user_id, article, name, purchase_cost, nmID, category)
+        await run_db(add_product, user_id, article, name, purchase_cost, nmID, category)
+        report_cache.invalidate(user_id)
         await update.message.reply_text(f"Товар '{article}' обновлён с закупочной стоимостью {purchase_cost} руб.")
     except ValueError:
         await update.message.reply_text("Стоимость должна быть числом (например, 300.50).")
@@ -152,54 +186,75 @@ async def add_product_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def load_products_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    user = get_user(user_id)
+    user = await run_db(get_user, user_id)
     if not user:
         await update.message.reply_text("Пожалуйста, зарегистрируйтесь с помощью /register.")
         return
 
+    # /load_products full — пройти весь каталог заново, иначе только изменённые с прошлой синхронизации
+    full = bool(context.args) and context.args[0].lower() == 'full'
     try:
-        products = await get_product_cards(user['wb_token'])
-        if not products:
-            await update.message.reply_text("Не удалось загрузить товары. Проверьте токен или логи.")
-            return
-
-        load_products(user_id, products)
+        counts = await sync_catalog(user, full=full)
         await update.message.reply_text(
-            f"Загружено {len(products)} товаров в базу для вашего аккаунта. Укажите закупочную стоимость через /add_product.")
+            f"Загружено {counts['fetched']} карточек в базу для вашего аккаунта: новых {counts['inserted']}, "
+            f"обновлено {counts['updated']}, без изменений {counts['unchanged']}. "
+            f"Укажите закупочную стоимость через /add_product.")
+    except WBApiError as e:
+        logging.error(f"Error loading products: {e}")
+        await update.message.reply_text("Не удалось загрузить товары. Проверьте токен или логи. "
+                                        "Уже загруженные страницы сохранены, повторите команду, чтобы продолжить.")
     except Exception as e:
         logging.error(f"Error loading products: {e}", exc_info=True)
         await update.message.reply_text(f"Ошибка при загрузке товаров: {str(e)}")
 
 async def import_costs_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    user = get_user(user_id)
+    user = await run_db(get_user, user_id)
     if not user:
         await update.message.reply_text("Пожалуйста, зарегистрируйтесь с помощью /register.")
         return
 
-    if not update.message.document:
-        await update.message.reply_text("Прикрепите CSV-файл с колонками 'article,cost'.")
+    document = update.message.document
+    if not document:
+        await update.message.reply_text(
+            "Отправьте CSV- или XLSX-файл с колонками 'article,cost' и подписью /import_costs.")
         return
 
-    file = await update.message.document.get_file()
-    file_data = await file.download_as_bytearray()
-    import csv
-    from io import StringIO
+    filename = document.file_name or 'costs.csv'
+    status = await update.message.reply_text("Загружаю файл...")
+    loop = asyncio.get_running_loop()
+    last_report = [0.0]
 
-    try:
-        csv_content = file_data.decode('utf-8')
-        reader = csv.DictReader(StringIO(csv_content))
-        updated = 0
-        for row in reader:
-            article = row['article'].lower()
-            cost = float(row['cost'])
-            current_product = get_product(article)
-            name = current_product.get('name', article) if current_product else article
-            nmID = current_product.get('nmID') if current_product else None
-            category = current_product.get('category') if current_product else None
-            add_product(article, name, cost, nmID, category)
-            updated += 1
-        await update.message.reply_text(f"Обновлено {updated} товаров из файла.")
-    except Exception as e:
-        logging.error(f"Error importing costs: {e}", exc_info=True)
-        await update.message.reply_text(f"Ошибка при загрузке: {str(e)}")
\ No newline at end of file
+    def report_progress(processed, updated, error_count):
+        # Вызывается из потока импорта: сообщение обновляется не чаще раза в COST_IMPORT_PROGRESS_INTERVAL
+        now = time.monotonic()
+        if now - last_report[0] >= COST_IMPORT_PROGRESS_INTERVAL:
+            last_report[0] = now
+            asyncio.run_coroutine_threadsafe(
+                status.edit_text(f"Обработано строк: {processed}, обновлено: {updated}, ошибок: {error_count}..."),
+                loop)
+
+    suffix = os.path.splitext(filename)[1]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, f"costs{suffix}")
+        try:
+            file = await document.get_file()
+            await file.download_to_drive(custom_path=path)
+            result = await run_db(import_costs, user_id, path, filename, report_progress)
+        except CostImportError as e:
+            await status.edit_text(f"Ошибка в файле: {e}")
+            return
+        except Exception as e:
+            logging.error(f"Error importing costs: {e}", exc_info=True)
+            await status.edit_text(f"Ошибка при загрузке: {str(e)}")
+            return
+
+    report_cache.invalidate(user_id)
+    text = f"Обновлено {result['updated']} товаров из файла (строк обработано: {result['processed']})."
+    if result['errors']:
+        shown = "\n".join(result['errors'][:COST_IMPORT_ERRORS_SHOWN])
+        more = len(result['errors']) - COST_IMPORT_ERRORS_SHOWN
+        text += f"\nПропущено строк с ошибками: {len(result['errors'])}\n{shown}"
+        if more > 0:
+            text += f"\n... и ещё {more}"
+    await status.edit_text(text)
@@ -2,8 +2,14 @@
 import logging
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 from bot.handlers import start, register, help_command, check_orders, handle_message, sales_report, add_product_command, \
-    load_products_command, import_costs_command
+    load_products_command, import_costs_command, labels_command
 from services.scheduler import start_scheduler, scheduler
+from services.wildberries_api import wb_client
+from services.telegram_sender import telegram_sender
+from services.order_pipeline import order_pipeline
+from database.db import close_db
+from services.barcode_gen import shutdown_render_pool
+from services.report_renderer import shutdown_report_pool
 from config.config import BOT_KEY
 
 logging.basicConfig(
@@ -13,17 +19,41 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+async def on_startup(application: Application) -> None:
+    await wb_client.start()
+    await telegram_sender.start(application.bot)
+    order_pipeline.start()
+
+async def on_stop(application: Application) -> None:
+    # post_stop срабатывает до bot.shutdown(): планировщик больше не ставит заданий, а очередь отправки успевает уйти
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    await order_pipeline.stop()  # Стадия send конвейера отправляет через telegram_sender
+    await telegram_sender.stop()
+
+async def on_shutdown(application: Application) -> None:
+    await wb_client.close()
+    shutdown_render_pool()
+    shutdown_report_pool()
+    close_db()
+
 def main():
-    application = Application.builder().token(BOT_KEY).build()
+    application = Application.builder().token(BOT_KEY).post_init(on_startup).post_stop(on_stop) \
+        .post_shutdown(on_shutdown).build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("register", register))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("check_orders", check_orders))
-    application.add_handler(CommandHandler("sales_report", sales_report))
+    application.add_handler(CommandHandler("labels", labels_command))
+    # Долгие команды (отчёт, синхронизация каталога, импорт) не блокируют обработку сообщений других чатов
+    application.add_handler(CommandHandler("sales_report", sales_report, block=False))
     application.add_handler(CommandHandler("add_product", add_product_command))
-    application.add_handler(CommandHandler("load_products", load_products_command))
-    application.add_handler(CommandHandler("import_costs", import_costs_command))
+    application.add_handler(CommandHandler("load_products", load_products_command, block=False))
+    application.add_handler(CommandHandler("import_costs", import_costs_command, block=False))
+    # Файл со стоимостями приходит документом с подписью /import_costs
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/import_costs'),
+                                           import_costs_command, block=False))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
     application.job_queue.run_once(start_scheduler, 0)
@@ -34,7 +64,8 @@ def main():
     except KeyboardInterrupt:
         logging.info("Shutting down bot...")
         application.stop()
-        scheduler.shutdown()
+        if scheduler.running:
+            scheduler.shutdown()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -5,3 +5,96 @@ API_KEY = ""
 BASE_URL = "https://marketplace-api.wildberries.ru/api/v3"
 CONTENT_URL = "https://content-api.wildberries.ru/content/v2/get/cards"
 CHECK_INTERVAL = 120  # Интервал проверки в секундах (изменил с 360 на 120, как в scheduler)
+
+# Общий HTTP-клиент Wildberries (keep-alive пул соединений)
+WB_CONNECTION_LIMIT = 100  # Всего открытых соединений
+WB_CONNECTION_LIMIT_PER_HOST = 20  # Соединений на один хост API
+WB_DNS_CACHE_TTL = 300  # Время жизни DNS-кэша в секундах
+WB_KEEPALIVE_TIMEOUT = 60  # Сколько держать простаивающее соединение открытым
+WB_REQUEST_TIMEOUT = 10  # Таймаут одного запроса по умолчанию
+
+# Лимиты запросов к API Wildberries на один токен: хост -> (запросов в минуту, допустимый всплеск)
+WB_RATE_LIMITS = {
+    "marketplace-api.wildberries.ru": (300, 20),
+    "content-api.wildberries.ru": (100, 5),
+    "statistics-api.wildberries.ru": (1, 2),  # 1 запрос в минуту на метод; всплеск 2 — остатки и отчёт одновременно
+}
+WB_DEFAULT_RATE_LIMIT = (60, 5)  # Для хостов, которых нет в WB_RATE_LIMITS
+WB_RETRY_ATTEMPTS = 4  # Попыток на запрос при 429, 5xx и сетевых ошибках
+WB_RETRY_BASE_DELAY = 1  # Начальная пауза экспоненциальной задержки, в секундах
+WB_RETRY_MAX_DELAY = 120  # Максимальная пауза; Retry-After длиннее этого не ждём
+
+# Параллельный опрос заказов
+POLL_CONCURRENCY = 10  # Сколько пользователей опрашивается одновременно
+POLL_USER_TIMEOUT = 90  # Таймаут обработки одного пользователя за цикл, в секундах
+
+# Дедупликация отправленных заказов
+SENT_ORDERS_TTL_DAYS = 14  # Сколько дней хранить отметку об отправленном заказе
+SENT_ORDERS_CACHE_SIZE = 10000  # Размер in-process кэша поверх таблицы sent_orders
+
+# База данных
+DB_PATH = "users.db"
+DB_WORKERS = 4  # Потоки для неблокирующего доступа к SQLite из asyncio (run_db)
+DB_BUSY_TIMEOUT = 30  # Сколько ждать освобождения блокировки записи, в секундах
+DB_CACHE_SIZE_KB = 16384  # Размер страничного кэша SQLite на соединение
+
+# Импорт закупочных стоимостей
+COST_IMPORT_CHUNK = 1000  # Строк в одной пачке записи
+COST_IMPORT_PROGRESS_INTERVAL = 3  # Как часто обновлять сообщение о прогрессе, в секундах
+COST_IMPORT_ERRORS_SHOWN = 20  # Сколько ошибочных строк показывать пользователю
+
+# Рендеринг этикеток
+LABEL_RENDER_MODE = "thread"  # "thread" или "process" — пул для генерации PDF этикеток
+LABEL_RENDER_WORKERS = 4  # Число потоков/процессов для рендеринга
+
+# Кэш этикеток
+LABEL_CACHE_SIZE = 512  # Сколько PDF держать в памяти (LRU)
+LABEL_CACHE_DIR = None  # Каталог дискового кэша, например "cache/labels"; None — только память
+LABEL_CACHE_DISK_MAX_MB = 200  # Предельный размер дискового кэша
+
+# Пакетные этикетки
+LABEL_BATCH_MODE = False  # True — все новые заказы цикла опроса одним сообщением и одним многостраничным PDF
+TELEGRAM_MESSAGE_LIMIT = 4096  # Максимальная длина сообщения Telegram
+
+LABEL_BARCODE_RENDERER = "vector"  # "vector" — штрихи Code128 рисуются в PDF напрямую, "raster" — PNG через ImageWriter
+
+# Отчёт реализации (reportDetailByPeriod)
+SALES_REPORT_PAGE_LIMIT = 100000  # Строк на страницу (максимум API)
+SALES_REPORT_PAGE_TIMEOUT = 120  # Таймаут одной страницы, в секундах
+SALES_REPORT_PAGE_RETRIES = 3  # Повторы одной страницы при ошибке
+SALES_REPORT_RETRY_DELAY = 60  # Пауза перед повтором (лимит метода — 1 запрос в минуту)
+
+# Локальный журнал продаж (sales_ledger)
+SALES_LEDGER_INITIAL_DAYS = 90  # Глубина первой загрузки, в днях
+SALES_SYNC_OVERLAP_DAYS = 7  # Перекрытие при догрузке: строки недельного отчёта приходят с задержкой
+SALES_SYNC_MIN_INTERVAL = 600  # Не ходить в API за дельтой чаще, чем раз в N секунд при запросе отчёта
+SALES_SYNC_INTERVAL_HOURS = 6  # Период фоновой синхронизации
+SALES_SYNC_CONCURRENCY = 5  # Сколько пользователей синхронизируется одновременно
+
+# Рендеринг отчётов (Excel и графики) в отдельных процессах
+REPORT_RENDER_WORKERS = 2  # Число процессов
+REPORT_QUEUE_LIMIT = 8  # Сколько отчётов может ждать и строиться одновременно; сверх этого — отказ
+
+# Кэш готовых отчётов
+REPORT_CACHE_SIZE = 32  # Сколько отчётов держать в памяти (LRU)
+REPORT_CACHE_TTL = 600  # Время жизни отчёта, в секундах: за это время в журнал могли прийти новые продажи
+
+WEEKLY_REPORT_CONCURRENCY = 2  # Сколько еженедельных отчётов пользователей строится одновременно (не больше REPORT_QUEUE_LIMIT)
+
+# Синхронизация каталога карточек (content API)
+CATALOG_PAGE_TIMEOUT = 30  # Таймаут одной страницы карточек, в секундах
+CATALOG_SYNC_INTERVAL_HOURS = 6  # Период фоновой догрузки изменённых карточек
+CATALOG_SYNC_CONCURRENCY = 5  # Сколько пользователей синхронизируется одновременно
+
+# Отправка сообщений в Telegram (общая очередь с лимитами)
+TELEGRAM_GLOBAL_RATE = 25  # Сообщений в секунду на весь бот (лимит Telegram — около 30)
+TELEGRAM_CHAT_RATE = 1  # Сообщений в секунду в один чат
+TELEGRAM_CHAT_BURST = 3  # Сколько сообщений в чат можно отправить подряд без паузы
+TELEGRAM_SENDER_WORKERS = 4  # Параллельных отправителей (разные чаты)
+TELEGRAM_SEND_ATTEMPTS = 3  # Попыток отправки при flood wait и сетевых ошибках
+
+# Конвейер уведомлений о заказах: данные карточки -> этикетка -> отправка
+ORDER_PIPELINE_QUEUE_SIZE = 50  # Вместимость очереди перед каждой стадией; при заполнении опрос ждёт
+ORDER_ENRICH_WORKERS = 8  # Обработчиков стадии данных карточки (сеть, каталог)
+ORDER_RENDER_WORKERS = 4  # Обработчиков стадии этикеток (обычно как LABEL_RENDER_WORKERS)
+ORDER_SEND_WORKERS = 4  # Обработчиков стадии отправки
@@ -1,100 +1,470 @@
 # database/db.py
+import asyncio
+import functools
+import logging
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from config.config import DB_PATH, DB_WORKERS, DB_BUSY_TIMEOUT, DB_CACHE_SIZE_KB
 
-def init_db():
-    conn = sqlite3.connect('users.db')
+# Колонки таблицы sales_ledger — поля строки reportDetailByPeriod, которые используют отчёты
+SALES_LEDGER_COLUMNS = (
+    ('rrd_id', 'INTEGER'), ('rr_dt', 'TEXT'), ('sale_dt', 'TEXT'), ('supplier_oper_name', 'TEXT'), ('sa_name', 'TEXT'),
+    ('subject_name', 'TEXT'), ('quantity', 'INTEGER'), ('ppvz_for_pay', 'REAL'), ('retail_price_withdisc_rub', 'REAL'),
+    ('ppvz_sales_commission', 'REAL'), ('delivery_rub', 'REAL'), ('return_amount', 'INTEGER'), ('office_name', 'TEXT')
+)
+SALES_LEDGER_FIELDS = tuple(name for name, _ in SALES_LEDGER_COLUMNS)
+
+_local = threading.local()
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+
+def connect():
+    """Новое соединение с настроенными PRAGMA (WAL, synchronous=NORMAL, busy_timeout).
+
+    Транзакции модуль sqlite3 не открывает (isolation_level=None): запись идёт только через transaction().
+    """
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, cached_statements=256, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT * 1000}")
+    # lower() SQLite не понимает кириллицу, а артикулы в products приведены к нижнему регистру Python
+    conn.create_function("py_lower", 1, lambda value: value.lower() if isinstance(value, str) else value,
+                         deterministic=True)
+    return conn
+
+
+def get_connection():
+    """Соединение текущего потока; переиспользуется между вызовами вместе с кэшем подготовленных запросов."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = connect()
+        _local.conn = conn
+    return conn
+
+
+@contextmanager
+def transaction(conn=None):
+    """Курсор в транзакции (по умолчанию на соединении текущего потока): commit при успехе, rollback при ошибке.
+
+    BEGIN IMMEDIATE берёт блокировку записи сразу: отложенная транзакция в WAL, начавшаяся с чтения,
+    при первой записи получила бы SQLITE_BUSY_SNAPSHOT без ожидания busy_timeout.
+    """
+    conn = conn or get_connection()
     cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users
-        (user_id INTEGER PRIMARY KEY, username TEXT, wb_token TEXT, chat_id TEXT)''')
-    # Новая таблица products с user_id
-    cursor.execute('''CREATE TABLE IF NOT EXISTS products
-        (user_id INTEGER, article TEXT, name TEXT, purchase_cost REAL DEFAULT 0.0, nmID INTEGER, category TEXT,
-         PRIMARY KEY (user_id, article))''')
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        yield cursor
+    except BaseException:
+        conn.rollback()
+        raise
     conn.commit()
-    conn.close()
+
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет синхронную функцию работы с БД в пуле потоков, не блокируя event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def close_db():
+    _executor.shutdown(wait=True)
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+    logging.info("Database executor stopped")
+
+
+def init_db():
+    with transaction() as cursor:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS users
+            (user_id INTEGER PRIMARY KEY, username TEXT, wb_token TEXT, chat_id TEXT)''')
+        # Новая таблица products с user_id
+        cursor.execute('''CREATE TABLE IF NOT EXISTS products
+            (user_id INTEGER, article TEXT, name TEXT, purchase_cost REAL DEFAULT 0.0, nmID INTEGER, category TEXT,
+             PRIMARY KEY (user_id, article))''')
+        # Дополнительные поля карточки для локального каталога (миграция старых баз)
+        existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(products)")}
+        for column in ('vendor_code', 'brand', 'photo'):
+            if column not in existing_columns:
+                cursor.execute(f"ALTER TABLE products ADD COLUMN {column} TEXT")
+        # Выборки по user_id обслуживает первичный ключ (user_id, article); nmID ищем отдельным индексом
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_nmid ON products (user_id, nmID)")
+        # Размеры карточек: chrtID -> баркод (sku) и размер WB
+        cursor.execute('''CREATE TABLE IF NOT EXISTS product_sizes
+            (user_id INTEGER, chrt_id INTEGER, article TEXT, sku TEXT, wb_size TEXT, PRIMARY KEY (user_id, chrt_id))''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_sizes_article ON product_sizes (user_id, article)")
+        # Заказы, по которым уже отправлено уведомление (защита от повторов после перезапуска)
+        cursor.execute('''CREATE TABLE IF NOT EXISTS sent_orders
+            (user_id INTEGER, order_id TEXT, sent_at INTEGER, PRIMARY KEY (user_id, order_id))''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sent_orders_sent_at ON sent_orders (sent_at)")
+        # Локальная копия отчёта реализации: прошлые строки не меняются, поэтому догружаем только новые
+        columns = ", ".join(f"{name} {sql_type}" for name, sql_type in SALES_LEDGER_COLUMNS)
+        cursor.execute(f'''CREATE TABLE IF NOT EXISTS sales_ledger
+            (user_id INTEGER, {columns}, PRIMARY KEY (user_id, rrd_id))''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_ledger_rr_dt ON sales_ledger (user_id, rr_dt)")
+        # Дневные агрегаты журнала по артикулам; quantity в ключе позволяет точно пересчитать затраты по новой цене
+        aggregates = ", ".join(f"{name} INTEGER DEFAULT 0" for name, _ in _SALES_DAILY_AGGREGATES)
+        cursor.execute(f'''CREATE TABLE IF NOT EXISTS sales_daily
+            (user_id INTEGER, rr_day TEXT, sale_day TEXT, article TEXT, quantity INTEGER, first_rrd_id INTEGER,
+             {aggregates}, PRIMARY KEY (user_id, rr_day, sale_day, article, quantity))''')
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM sales_daily) OR NOT EXISTS (SELECT 1 FROM sales_ledger)")
+        if not cursor.fetchone()[0]:
+            # Журнал заполнен до появления агрегатов: строим их один раз по всем строкам
+            _rebuild_sales_daily(cursor)
+        # Курсор content API (updatedAt, nmID) последней загруженной карточки для догрузки изменений
+        cursor.execute('''CREATE TABLE IF NOT EXISTS catalog_sync_state
+            (user_id INTEGER PRIMARY KEY, updated_at TEXT, nm_id INTEGER, synced_at INTEGER)''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS sales_sync_state
+            (user_id INTEGER PRIMARY KEY, synced_from TEXT, last_rrd_id INTEGER, last_rr_dt TEXT, synced_at INTEGER)''')
+    get_connection().execute("PRAGMA optimize")
 
 def add_user(user_id, username, wb_token, chat_id):
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO users (user_id, username, wb_token, chat_id) VALUES (?, ?, ?, ?)",
-                   (user_id, username, wb_token, chat_id))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("INSERT OR REPLACE INTO users (user_id, username, wb_token, chat_id) VALUES (?, ?, ?, ?)",
+                       (user_id, username, wb_token, chat_id))
 
 def get_user(user_id):
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
     user = cursor.fetchone()
-    conn.close()
     if user:
         return {'user_id': user[0], 'username': user[1], 'wb_token': user[2], 'chat_id': user[3]}
     return None
 
 def get_all_users():
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute("SELECT * FROM users")
     users = cursor.fetchall()
-    conn.close()
     return [{'user_id': user[0], 'username': user[1], 'wb_token': user[2], 'chat_id': user[3]} for user in users]
 
 def remove_user(user_id):
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
 
 
 def add_product(user_id, article, name, purchase_cost=0.0, nmID=None, category=None):
     article = article.lower()
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR REPLACE INTO products (user_id, article, name, purchase_cost, nmID, category) VALUES (?, ?, ?, ?, ?, ?)",
-        (user_id, article, name, purchase_cost, nmID, category))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        # UPSERT вместо INSERT OR REPLACE, чтобы не затирать данные каталога (бренд, фото, размеры)
+        cursor.execute(
+            "INSERT INTO products (user_id, article, name, purchase_cost, nmID, category) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (user_id, article) DO UPDATE SET name = excluded.name, purchase_cost = excluded.purchase_cost, "
+            "nmID = excluded.nmID, category = excluded.category",
+            (user_id, article, name, purchase_cost, nmID, category))
 
 
 def get_product(user_id, article):
     article = article.lower()
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute(
         "SELECT article, name, purchase_cost, nmID, category FROM products WHERE user_id = ? AND article = ?",
         (user_id, article))
     product = cursor.fetchone()
-    conn.close()
     return {'article': product[0], 'name': product[1], 'purchase_cost': product[2], 'nmID': product[3],
             'category': product[4]} if product else {'purchase_cost': 0.0}
 
 
-def load_products(user_id, products):
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
+def get_cost_map(user_id):
+    """Все закупочные стоимости пользователя одним запросом: {article (lower): purchase_cost}."""
+    cursor = get_connection().cursor()
     cursor.execute("SELECT article, purchase_cost FROM products WHERE user_id = ?", (user_id,))
-    existing_products = {row[0]: row[1] for row in cursor.fetchall()}
-
-    for product in products:
-        article = product.get('vendorCode', 'Unknown').lower()
-        name = product.get('title', 'Unknown')
-        nmID = product.get('nmID')
-        category = product.get('subjectName')
-        purchase_cost = existing_products.get(article, 0.0)
+    return {row[0]: row[1] or 0.0 for row in cursor.fetchall()}
+
+
+def _card_row(card):
+    """Строка каталога из карточки товара content API: (article, name, nmID, category, vendor_code, brand, photo)."""
+    photos = card.get('photos') or []
+    return (card.get('vendorCode', 'Unknown').lower(), card.get('title', 'Unknown'), card.get('nmID'),
+            card.get('subjectName'), card.get('vendorCode'), card.get('brand'),
+            photos[0].get('big') if photos else None)
+
+
+def _card_size_rows(card):
+    """Размеры карточки: [(chrt_id, article, sku, wb_size), ...]."""
+    article = card.get('vendorCode', 'Unknown').lower()
+    return [(size.get('chrtID'), article, (size.get('skus') or [''])[0], size.get('wbSize'))
+            for size in card.get('sizes', []) if size.get('chrtID') is not None]
+
+
+_CATALOG_FIELDS = ('name', 'nmID', 'category', 'vendor_code', 'brand', 'photo')
+
+
+def upsert_catalog(user_id, products):
+    """Массовая синхронизация каталога карточек одной транзакцией.
+
+    Карточки складываются во временную таблицу через executemany, затем переносятся в products
+    одним INSERT ... ON CONFLICT DO UPDATE: закупочная стоимость не трогается, а строки без
+    изменений не перезаписываются. Возвращает {'inserted': .., 'updated': .., 'unchanged': ..}.
+    """
+    conn = get_connection()
+    # Блокировка записи берётся до первого чтения: подсчёт новых карточек и upsert видят один снимок
+    with transaction(conn) as cursor:
+        cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS catalog_stage
+            (article TEXT PRIMARY KEY, name TEXT, nmID INTEGER, category TEXT, vendor_code TEXT, brand TEXT, photo TEXT)''')
+        cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS catalog_sizes_stage
+            (chrt_id INTEGER PRIMARY KEY, article TEXT, sku TEXT, wb_size TEXT)''')
+        cursor.execute("DELETE FROM catalog_stage")
+        cursor.execute("DELETE FROM catalog_sizes_stage")
+        # При повторе артикула побеждает последняя карточка, как и раньше
+        cursor.executemany(
+            "INSERT OR REPLACE INTO catalog_stage (article, name, nmID, category, vendor_code, brand, photo) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (_card_row(card) for card in products))
+        cursor.executemany(
+            "INSERT OR REPLACE INTO catalog_sizes_stage (chrt_id, article, sku, wb_size) VALUES (?, ?, ?, ?)",
+            (row for card in products for row in _card_size_rows(card)))
+
+        cursor.execute("SELECT COUNT(*) FROM catalog_stage")
+        total = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM catalog_stage s WHERE NOT EXISTS "
+                       "(SELECT 1 FROM products p WHERE p.user_id = ? AND p.article = s.article)", (user_id,))
+        inserted = cursor.fetchone()[0]
+
+        changed = " OR ".join(f"products.{field} IS NOT excluded.{field}" for field in _CATALOG_FIELDS)
+        updates = ", ".join(f"{field} = excluded.{field}" for field in _CATALOG_FIELDS)
+        changes_before = conn.total_changes
+        # WHERE true нужен парсеру SQLite, чтобы отличить ON CONFLICT от JOIN-условия
         cursor.execute(
-            "INSERT OR REPLACE INTO products (user_id, article, name, purchase_cost, nmID, category) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, article, name, purchase_cost, nmID, category))
+            f"INSERT INTO products (user_id, article, name, nmID, category, vendor_code, brand, photo) "
+            f"SELECT ?, article, name, nmID, category, vendor_code, brand, photo FROM catalog_stage WHERE true "
+            f"ON CONFLICT (user_id, article) DO UPDATE SET {updates} WHERE {changed}",
+            (user_id,))
+        updated = conn.total_changes - changes_before - inserted
+
+        cursor.execute(
+            "DELETE FROM product_sizes WHERE user_id = ? AND article IN (SELECT article FROM catalog_stage) "
+            "AND chrt_id NOT IN (SELECT chrt_id FROM catalog_sizes_stage)", (user_id,))
+        cursor.execute(
+            "INSERT INTO product_sizes (user_id, chrt_id, article, sku, wb_size) "
+            "SELECT ?, chrt_id, article, sku, wb_size FROM catalog_sizes_stage WHERE true "
+            "ON CONFLICT (user_id, chrt_id) DO UPDATE SET article = excluded.article, sku = excluded.sku, "
+            "wb_size = excluded.wb_size WHERE product_sizes.article IS NOT excluded.article "
+            "OR product_sizes.sku IS NOT excluded.sku OR product_sizes.wb_size IS NOT excluded.wb_size",
+            (user_id,))
+        cursor.execute("DELETE FROM catalog_stage")
+        cursor.execute("DELETE FROM catalog_sizes_stage")
+
+    return {'inserted': inserted, 'updated': updated, 'unchanged': total - inserted - updated}
 
-    conn.commit()
-    conn.close()
+
+def load_products(user_id, products):
+    """Загружает карточки товаров в каталог пользователя; см. upsert_catalog."""
+    counts = upsert_catalog(user_id, products)
+    logging.info(f"Catalog sync for user {user_id}: {counts['inserted']} inserted, "
+                 f"{counts['updated']} updated, {counts['unchanged']} unchanged")
+    return counts
+
+
+def save_product_card(user_id, card):
+    """Сохраняет одну карточку товара в локальный каталог, сохраняя закупочную стоимость."""
+    return upsert_catalog(user_id, [card])
+
+
+def get_catalog_sync_state(user_id):
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT updated_at, nm_id, synced_at FROM catalog_sync_state WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {'updatedAt': row[0], 'nmID': row[1], 'synced_at': row[2]}
+
+
+def set_catalog_sync_state(user_id, updated_at, nm_id):
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT OR REPLACE INTO catalog_sync_state (user_id, updated_at, nm_id, synced_at) VALUES (?, ?, ?, ?)",
+            (user_id, updated_at, nm_id, int(time.time())))
+
+
+def _catalog_card(cursor, user_id, article):
+    cursor.execute(
+        "SELECT article, name, vendor_code, brand, photo, nmID, category FROM products WHERE user_id = ? AND article = ?",
+        (user_id, article))
+    product = cursor.fetchone()
+    if not product:
+        return None
+    cursor.execute("SELECT chrt_id, sku, wb_size FROM product_sizes WHERE user_id = ? AND article = ? ORDER BY rowid",
+                   (user_id, article))
+    sizes = [{'chrtID': s[0], 'sku': s[1], 'wbSize': s[2]} for s in cursor.fetchall()]
+    return {'article': product[0], 'name': product[1], 'vendor_code': product[2], 'brand': product[3],
+            'photo': product[4], 'nmID': product[5], 'category': product[6], 'sizes': sizes}
+
+
+def get_catalog_card(user_id, article):
+    """Карточка из локального каталога по артикулу продавца (с размерами) или None."""
+    return _catalog_card(get_connection().cursor(), user_id, article.lower())
+
+
+def get_catalog_card_by_chrt_id(user_id, chrt_id):
+    """Карточка из локального каталога по chrtID размера или None."""
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT article FROM product_sizes WHERE user_id = ? AND chrt_id = ?", (user_id, chrt_id))
+    row = cursor.fetchone()
+    return _catalog_card(cursor, user_id, row[0]) if row else None
+
+
+def get_product_by_nm_id(user_id, nm_id):
+    """Карточка из локального каталога по nmID или None."""
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT article FROM products WHERE user_id = ? AND nmID = ?", (user_id, nm_id))
+    row = cursor.fetchone()
+    return _catalog_card(cursor, user_id, row[0]) if row else None
 
 
 def get_all_products(user_id):
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute("SELECT article, name, purchase_cost, nmID, category FROM products WHERE user_id = ?", (user_id,))
     products = cursor.fetchall()
-    conn.close()
-    return [{'article': p[0], 'name': p[1], 'purchase_cost': p[2], 'nmID': p[3], 'category': p[4]} for p in products]
\ No newline at end of file
+    return [{'article': p[0], 'name': p[1], 'purchase_cost': p[2], 'nmID': p[3], 'category': p[4]} for p in products]
+
+
+def get_sent_orders(user_id, order_ids):
+    """Возвращает {order_id: sent_at} для тех из переданных заказов, по которым уведомление уже отправлялось."""
+    order_ids = [str(order_id) for order_id in order_ids]
+    if not order_ids:
+        return {}
+    cursor = get_connection().cursor()
+    sent = {}
+    # Ограничение SQLite на число параметров в запросе
+    for i in range(0, len(order_ids), 500):
+        chunk = order_ids[i:i + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(f"SELECT order_id, sent_at FROM sent_orders WHERE user_id = ? AND order_id IN ({placeholders})",
+                       (user_id, *chunk))
+        sent.update((row[0], row[1]) for row in cursor.fetchall())
+    return sent
+
+
+def mark_order_sent(user_id, order_id, sent_at=None):
+    with transaction() as cursor:
+        cursor.execute("INSERT OR REPLACE INTO sent_orders (user_id, order_id, sent_at) VALUES (?, ?, ?)",
+                       (user_id, str(order_id), int(sent_at if sent_at is not None else time.time())))
+
+
+def purge_sent_orders(older_than):
+    """Удаляет записи об отправленных заказах старше older_than (unix time). Возвращает число удалённых."""
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM sent_orders WHERE sent_at < ?", (int(older_than),))
+        return cursor.rowcount
+
+
+# Агрегаты sales_daily, пересчитываемые из строк журнала (продажа — supplier_oper_name = 'Продажа').
+# Копейки считаются как в отчётах: int(x * 100) по каждой строке, затем сумма.
+_SALES_DAILY_AGGREGATES = (
+    ('sales_count', "SUM(s.supplier_oper_name = 'Продажа')"),
+    ('sold_quantity', "SUM(CASE WHEN s.supplier_oper_name = 'Продажа' THEN COALESCE(s.quantity, 0) ELSE 0 END)"),
+    ('revenue_kop', "SUM(CASE WHEN s.supplier_oper_name = 'Продажа' "
+                    "THEN CAST(COALESCE(s.ppvz_for_pay, 0) * 100 AS INTEGER) ELSE 0 END)"),
+    ('commission_kop', "SUM(CASE WHEN s.supplier_oper_name = 'Продажа' "
+                       "THEN CAST(COALESCE(s.ppvz_sales_commission, 0) * 100 AS INTEGER) ELSE 0 END)"),
+    ('delivery_kop', "SUM(CAST(COALESCE(s.delivery_rub, 0) * 100 AS INTEGER))"),
+    ('sales_delivery_kop', "SUM(CASE WHEN s.supplier_oper_name = 'Продажа' "
+                           "THEN CAST(COALESCE(s.delivery_rub, 0) * 100 AS INTEGER) ELSE 0 END)"),
+    ('returns', "SUM(COALESCE(s.return_amount, 0))"),
+    ('cost_kop', "SUM(CASE WHEN s.supplier_oper_name = 'Продажа' "
+                 "THEN CAST(COALESCE(p.purchase_cost, 0) * COALESCE(s.quantity, 0) * 100 AS INTEGER) ELSE 0 END)"),
+)
+SALES_DAILY_FIELDS = ('rr_day', 'sale_day', 'article', 'quantity', 'first_rrd_id') + \
+    tuple(name for name, _ in _SALES_DAILY_AGGREGATES)
+
+
+def _rebuild_sales_daily(cursor):
+    cursor.execute("SELECT DISTINCT user_id FROM sales_ledger")
+    for (user_id,) in cursor.fetchall():
+        cursor.execute("DROP VIEW IF EXISTS temp.sales_rebuild_source")
+        cursor.execute(f"CREATE TEMP VIEW sales_rebuild_source AS SELECT *, py_lower(sa_name) AS article_key "
+                       f"FROM sales_ledger WHERE user_id = {int(user_id)}")
+        _rollup_sales(cursor, user_id, "sales_rebuild_source")
+    cursor.execute("DROP VIEW IF EXISTS temp.sales_rebuild_source")
+
+
+def _rollup_sales(cursor, user_id, source):
+    """Добавляет агрегаты строк из source (таблица с колонками журнала и article_key) в sales_daily."""
+    aggregates = ", ".join(expression for _, expression in _SALES_DAILY_AGGREGATES)
+    names = ", ".join(name for name, _ in _SALES_DAILY_AGGREGATES)
+    increments = ", ".join(f"{name} = sales_daily.{name} + excluded.{name}" for name, _ in _SALES_DAILY_AGGREGATES)
+    cursor.execute(
+        f"INSERT INTO sales_daily (user_id, rr_day, sale_day, article, quantity, first_rrd_id, {names}) "
+        f"SELECT ?, substr(COALESCE(s.rr_dt, ''), 1, 10), substr(COALESCE(s.sale_dt, ''), 1, 10), "
+        f"COALESCE(s.sa_name, 'Неизвестно'), COALESCE(s.quantity, 0), MIN(s.rrd_id), {aggregates} "
+        f"FROM {source} s LEFT JOIN products p ON p.user_id = ? AND p.article = s.article_key "
+        f"GROUP BY 2, 3, 4, 5 "
+        f"ON CONFLICT (user_id, rr_day, sale_day, article, quantity) DO UPDATE SET {increments}, "
+        f"first_rrd_id = MIN(sales_daily.first_rrd_id, excluded.first_rrd_id)",
+        (user_id, user_id))
+
+
+def insert_sales_rows(user_id, rows):
+    """Добавляет строки отчёта реализации в sales_ledger и обновляет дневные агрегаты sales_daily.
+
+    Уже известные rrd_id пропускаются; агрегаты наращиваются только по действительно новым строкам,
+    закупочная стоимость берётся текущая (на момент загрузки). Возвращает число новых строк.
+    """
+    conn = get_connection()
+    columns = ", ".join(SALES_LEDGER_FIELDS)
+    # Проверка известных rrd_id и вставка идут под одной блокировкой записи
+    with transaction(conn) as cursor:
+        cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS sales_stage "
+                       f"({', '.join(f'{name} {sql_type}' for name, sql_type in SALES_LEDGER_COLUMNS)}, "
+                       f"article_key TEXT, PRIMARY KEY (rrd_id))")
+        cursor.execute("DELETE FROM sales_stage")
+        cursor.executemany(
+            f"INSERT OR IGNORE INTO sales_stage ({columns}, article_key) "
+            f"VALUES ({', '.join('?' * (len(SALES_LEDGER_FIELDS) + 1))})",
+            ((*(row.get(field) for field in SALES_LEDGER_FIELDS), (row.get('sa_name') or '').lower())
+             for row in rows if row.get('rrd_id')))
+        cursor.execute("DELETE FROM sales_stage WHERE EXISTS "
+                       "(SELECT 1 FROM sales_ledger l WHERE l.user_id = ? AND l.rrd_id = sales_stage.rrd_id)",
+                       (user_id,))
+        cursor.execute("SELECT COUNT(*) FROM sales_stage")
+        inserted = cursor.fetchone()[0]
+        if inserted:
+            cursor.execute(f"INSERT INTO sales_ledger (user_id, {columns}) SELECT ?, {columns} FROM sales_stage",
+                           (user_id,))
+            _rollup_sales(cursor, user_id, "sales_stage")
+        cursor.execute("DELETE FROM sales_stage")
+        return inserted
+
+
+def get_sales_daily(user_id, date_from, date_to):
+    """Дневные агрегаты продаж по артикулам за период по дате отчёта (rr_dt), включая обе границы."""
+    cursor = get_connection().cursor()
+    cursor.execute(
+        f"SELECT {', '.join(SALES_DAILY_FIELDS)} FROM sales_daily "
+        f"WHERE user_id = ? AND rr_day >= ? AND rr_day <= ? ORDER BY first_rrd_id",
+        (user_id, date_from, date_to))
+    return [dict(zip(SALES_DAILY_FIELDS, row)) for row in cursor.fetchall()]
+
+
+def get_sales_rows(user_id, date_from, date_to):
+    """Строки отчёта реализации за период по дате отчёта (rr_dt), включая обе границы. date_* — 'YYYY-MM-DD'."""
+    cursor = get_connection().cursor()
+    cursor.execute(
+        f"SELECT {', '.join(SALES_LEDGER_FIELDS)} FROM sales_ledger "
+        f"WHERE user_id = ? AND rr_dt >= ? AND rr_dt < date(?, '+1 day') ORDER BY rrd_id",
+        (user_id, date_from, date_to))
+    return [dict(zip(SALES_LEDGER_FIELDS, row)) for row in cursor.fetchall()]
+
+
+def get_sales_sync_state(user_id):
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT synced_from, last_rrd_id, last_rr_dt, synced_at FROM sales_sync_state WHERE user_id = ?",
+                   (user_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {'synced_from': row[0], 'last_rrd_id': row[1], 'last_rr_dt': row[2], 'synced_at': row[3]}
+
+
+def set_sales_sync_state(user_id, synced_from, last_rrd_id, last_rr_dt):
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT OR REPLACE INTO sales_sync_state (user_id, synced_from, last_rrd_id, last_rr_dt, synced_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (user_id, synced_from, last_rrd_id, last_rr_dt, int(time.time())))
@@ -1,6 +1,10 @@
 # services/barcode_gen.py
+import asyncio
 import io
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 from barcode import Code128  # Импортируем конкретный класс
 from barcode.writer import ImageWriter
 from reportlab.pdfgen import canvas
@@ -8,6 +12,8 @@ from reportlab.lib.units import inch
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfbase import pdfmetrics
 from PIL import Image
+from config.config import LABEL_RENDER_MODE, LABEL_RENDER_WORKERS, LABEL_BARCODE_RENDERER
+from services.label_cache import label_cache, label_key
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,56 +23,206 @@ logging.basicConfig(
 )
 pdfmetrics.registerFont(TTFont("Arial", "arialmt.ttf"))
 
+_render_executor = None
+render_stats = {'count': 0, 'failed': 0, 'render_time': 0.0, 'total_time': 0.0, 'max_total_time': 0.0}
+
+
+def _get_render_executor():
+    global _render_executor
+    if _render_executor is None:
+        if LABEL_RENDER_MODE == "process":
+            # spawn: дочерние процессы не наследуют потоки и соединения бота
+            _render_executor = ProcessPoolExecutor(max_workers=LABEL_RENDER_WORKERS,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+        else:
+            _render_executor = ThreadPoolExecutor(max_workers=LABEL_RENDER_WORKERS, thread_name_prefix="label")
+        logging.info(f"Label render pool started: {LABEL_RENDER_MODE}, {LABEL_RENDER_WORKERS} workers")
+    return _render_executor
+
+
+def shutdown_render_pool():
+    global _render_executor
+    if _render_executor is not None:
+        _render_executor.shutdown(wait=True)
+        _render_executor = None
+        logging.info("Label render pool stopped")
+
+
 async def generate_barcode(sku, product_name, article, brand=None, size=None):
-    width_inch, height_inch = 2.40, 1.57
+    """Генерирует PDF-этикетку в пуле рендеринга, не блокируя event loop. Возвращает BytesIO или None.
+
+    Готовые этикетки берутся из label_cache: повторные заказы того же SKU не рендерятся заново.
+    """
+    key = label_key(sku, product_name, article, brand, size)
+    cached = await label_cache.get(key)
+    if cached is not None:
+        logging.info(f"Label cache hit for SKU {sku} (hit ratio {label_cache.hit_ratio():.0%}, {label_cache.stats})")
+        return io.BytesIO(cached)
+
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
     try:
-        barcode_buffer = io.BytesIO()
-        # Используем Code128 вместо barcode.get
-        code128 = Code128(str(sku), writer=ImageWriter())
-        code128.write(barcode_buffer)
-        barcode_buffer.seek(0)
-        barcode_image = Image.open(barcode_buffer)
+        pdf_bytes, render_time = await loop.run_in_executor(
+            _get_render_executor(), render_label, sku, product_name, article, brand, size)
+    except Exception as e:
+        logging.error(f"Ошибка в пуле рендеринга этикеток: {e}")
+        pdf_bytes, render_time = None, 0.0
+    total_time = time.monotonic() - started
+    render_stats['count'] += 1
+    render_stats['render_time'] += render_time
+    render_stats['total_time'] += total_time
+    render_stats['max_total_time'] = max(render_stats['max_total_time'], total_time)
+    if pdf_bytes is None:
+        render_stats['failed'] += 1
+        return None
+    logging.info(f"Label for SKU {sku} rendered in {render_time * 1000:.1f} ms "
+                 f"(with queue wait {total_time * 1000:.1f} ms, "
+                 f"avg {render_stats['total_time'] / render_stats['count'] * 1000:.1f} ms, "
+                 f"cache hit ratio {label_cache.hit_ratio():.0%})")
+    await label_cache.put(key, pdf_bytes)
+    return io.BytesIO(pdf_bytes)
+
+
+async def generate_label_sheet(labels):
+    """Рендерит список этикеток (sku, product_name, article, brand, size) в один многостраничный PDF.
+
+    Возвращает (BytesIO или None, число страниц).
+    """
+    if not labels:
+        return None, 0
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+    try:
+        pdf_bytes, render_time, pages = await loop.run_in_executor(_get_render_executor(), render_label_sheet,
+                                                                   [tuple(label) for label in labels])
+    except Exception as e:
+        logging.error(f"Ошибка в пуле рендеринга этикеток: {e}")
+        return None, 0
+    logging.info(f"Label sheet with {pages}/{len(labels)} pages rendered in {render_time * 1000:.1f} ms "
+                 f"(with queue wait {(time.monotonic() - started) * 1000:.1f} ms)")
+    return (io.BytesIO(pdf_bytes) if pdf_bytes else None), pages
+
+
+LABEL_WIDTH_INCH, LABEL_HEIGHT_INCH = 2.40, 1.57
+LABEL_PAGE_SIZE = (LABEL_WIDTH_INCH * inch, LABEL_HEIGHT_INCH * inch)
+
 
+def _draw_multiline_text(c, text, x, y, max_width, line_height):
+    words = text.split(" ")
+    current_line, current_y, lines_drawn = "", y, 0
+    for word in words:
+        if c.stringWidth(current_line + word, "Arial", 10) < max_width:
+            current_line += word + " "
+        else:
+            c.drawString(x, current_y, current_line.strip())
+            current_line = word + " "
+            current_y -= line_height
+            lines_drawn += 1
+            if current_y < 0:
+                break
+    if current_line and current_y >= 0:
+        c.drawString(x, current_y, current_line.strip())
+        lines_drawn += 1
+    return lines_drawn
+
+
+def _draw_barcode_raster(c, sku, x, y, width, height):
+    """Растровый путь: PNG через python-barcode ImageWriter, встроенный в PDF."""
+    barcode_buffer = io.BytesIO()
+    # Используем Code128 вместо barcode.get
+    code128 = Code128(str(sku), writer=ImageWriter())
+    code128.write(barcode_buffer)
+    barcode_buffer.seek(0)
+    barcode_image = Image.open(barcode_buffer)
+    c.drawInlineImage(barcode_image, x, y, width=width, height=height)
+
+
+def _draw_barcode_vector(c, sku, x, y, width, height, quiet_modules=10, font_size=7):
+    """Векторный путь: штрихи Code128 рисуются прямоугольниками прямо на холсте, под ними — цифры баркода."""
+    code128 = Code128(str(sku))
+    modules = code128.build()[0]
+    module_width = width / (len(modules) + 2 * quiet_modules)
+    text_height = font_size + 2
+    bar_y, bar_height = y + text_height, height - text_height
+
+    bar_x, run = x + quiet_modules * module_width, 0
+    for i, module in enumerate(modules + "0"):
+        if module == "1":
+            run += 1
+        elif run:
+            # Соседние модули-штрихи объединяются в один прямоугольник
+            c.rect(bar_x + (i - run) * module_width, bar_y, run * module_width, bar_height, stroke=0, fill=1)
+            run = 0
+
+    c.setFont("Arial", font_size)
+    c.drawCentredString(x + width / 2, y, code128.get_fullcode())
+    c.setFont("Arial", 10)
+
+
+def _draw_label(c, sku, product_name, article, brand=None, size=None):
+    """Рисует одну этикетку на текущей странице холста.
+
+    Баркод кодируется до того, как на страницу что-то попадёт: если SKU не кодируется в Code128
+    (например, «Не указано»), ошибка поднимается на чистой странице и следующая этикетка её не перекроет.
+    """
+    Code128(str(sku)).build()
+    width_inch, height_inch = LABEL_WIDTH_INCH, LABEL_HEIGHT_INCH
+    c.setFont("Arial", 10)
+    texts = [product_name, f"Артикул: {article}"]
+    if brand:
+        texts.append(f"Бренд: {brand}")
+    if size:
+        texts.append(f"Размер: {size}")
+
+    current_height = height_inch - 0.2
+    max_width = width_inch * inch - 20
+    for text in texts:
+        lines_drawn = _draw_multiline_text(c, text, 10, current_height * inch, max_width, 0.12 * inch)
+        current_height -= lines_drawn * 0.12
+
+    barcode_width, barcode_height = 90, 65
+    barcode_x, barcode_y = (width_inch * inch - barcode_width) / 2, (current_height - 0.8) * inch
+    if LABEL_BARCODE_RENDERER == "vector":
+        try:
+            _draw_barcode_vector(c, sku, barcode_x, barcode_y, barcode_width, barcode_height)
+            return
+        except Exception as e:
+            logging.warning(f"Vector barcode failed for SKU {sku}, falling back to raster: {e}")
+    _draw_barcode_raster(c, sku, barcode_x, barcode_y, barcode_width, barcode_height)
+
+
+def render_label(sku, product_name, article, brand=None, size=None):
+    """Синхронный рендеринг этикетки. Возвращает (байты PDF или None, время рендеринга в секундах)."""
+    started = time.perf_counter()
+    try:
         pdf_buffer = io.BytesIO()
-        c = canvas.Canvas(pdf_buffer, pagesize=(width_inch * inch, height_inch * inch))
-        c.setFont("Arial", 10)
-
-        def draw_multiline_text(c, text, x, y, max_width, line_height):
-            words = text.split(" ")
-            current_line, current_y, lines_drawn = "", y, 0
-            for word in words:
-                if c.stringWidth(current_line + word, "Arial", 10) < max_width:
-                    current_line += word + " "
-                else:
-                    c.drawString(x, current_y, current_line.strip())
-                    current_line = word + " "
-                    current_y -= line_height
-                    lines_drawn += 1
-                    if current_y < 0:
-                        break
-            if current_line and current_y >= 0:
-                c.drawString(x, current_y, current_line.strip())
-                lines_drawn += 1
-            return lines_drawn
-
-        texts = [product_name, f"Артикул: {article}"]
-        if brand:
-            texts.append(f"Бренд: {brand}")
-        if size:
-            texts.append(f"Размер: {size}")
-
-        current_height = height_inch - 0.2
-        max_width = width_inch * inch - 20
-        for text in texts:
-            lines_drawn = draw_multiline_text(c, text, 10, current_height * inch, max_width, 0.12 * inch)
-            current_height -= lines_drawn * 0.12
-
-        barcode_width, barcode_height = 90, 65
-        c.drawInlineImage(barcode_image, (width_inch * inch - barcode_width) / 2, (current_height - 0.8) * inch,
-                          width=barcode_width, height=barcode_height)
+        c = canvas.Canvas(pdf_buffer, pagesize=LABEL_PAGE_SIZE)
+        _draw_label(c, sku, product_name, article, brand, size)
         c.save()
-        pdf_buffer.seek(0)
-        return pdf_buffer
+        return pdf_buffer.getvalue(), time.perf_counter() - started
     except Exception as e:
         logging.error(f"Ошибка при генерации PDF: {e}")
-        return None
\ No newline at end of file
+        return None, time.perf_counter() - started
+
+
+def render_label_sheet(labels):
+    """Рендерит несколько этикеток в один многостраничный PDF на общем холсте (шрифт и формат страницы одни).
+
+    labels — список кортежей (sku, product_name, article, brand, size). Этикетки с ошибкой пропускаются.
+    Возвращает (байты PDF или None, время рендеринга в секундах, число отрисованных страниц).
+    """
+    started = time.perf_counter()
+    pdf_buffer = io.BytesIO()
+    c = canvas.Canvas(pdf_buffer, pagesize=LABEL_PAGE_SIZE)
+    pages = 0
+    for label in labels:
+        try:
+            _draw_label(c, *label)
+            c.showPage()
+            pages += 1
+        except Exception as e:
+            logging.error(f"Ошибка при генерации этикетки {label[0]} в пакете: {e}")
+    if not pages:
+        return None, time.perf_counter() - started, 0
+    c.save()
+    return pdf_buffer.getvalue(), time.perf_counter() - started, pages
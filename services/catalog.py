@@ -0,0 +1,53 @@
+# services/catalog.py
+import logging
+from database.db import get_catalog_card, get_catalog_card_by_chrt_id, save_product_card, run_db
+from services.wildberries_api import fetch_product_info
+
+
+def _pick_card(cards, article):
+    """Из результатов текстового поиска выбирает карточку с точным совпадением артикула."""
+    article = (article or '').lower()
+    for card in cards:
+        if card.get('vendorCode', '').lower() == article:
+            return card
+    return cards[0]
+
+
+async def get_product_details(user_id, wb_token, article, chrt_id=None):
+    """Данные товара для уведомлений и этикеток.
+
+    Сначала ищет в локальном каталоге (по chrtID, затем по артикулу), при промахе
+    запрашивает content API и сохраняет найденную карточку в каталог.
+    Возвращает dict с ключами title, vendor_code, brand, photo, sizes или None.
+    """
+    card = None
+    if chrt_id is not None:
+        card = await run_db(get_catalog_card_by_chrt_id, user_id, chrt_id)
+    if card is None and article:
+        card = await run_db(get_catalog_card, user_id, article)
+        # Карточка могла измениться: если нужного размера нет, идём в API
+        if card is not None and chrt_id is not None and not any(s['chrtID'] == chrt_id for s in card['sizes']):
+            card = None
+    if card is not None:
+        logging.info(f"Catalog hit for article {article} (chrtId {chrt_id})")
+        return {'title': card['name'], 'vendor_code': card['vendor_code'] or card['article'], 'brand': card['brand'],
+                'photo': card['photo'], 'sizes': card['sizes']}
+
+    logging.info(f"Catalog miss for article {article} (chrtId {chrt_id}), fetching from API")
+    product_info = await fetch_product_info(article, wb_token)
+    if not product_info or not product_info.get('cards'):
+        return None
+    product = _pick_card(product_info['cards'], article)
+    try:
+        await run_db(save_product_card, user_id, product)
+    except Exception as e:
+        logging.error(f"Failed to save product card {product.get('vendorCode')} to catalog: {e}")
+    photos = product.get('photos', [])
+    return {
+        'title': product.get('title'),
+        'vendor_code': product.get('vendorCode'),
+        'brand': product.get('brand'),
+        'photo': photos[0]['big'] if photos else None,
+        'sizes': [{'chrtID': size.get('chrtID'), 'sku': (size.get('skus') or [''])[0], 'wbSize': size.get('wbSize')}
+                  for size in product.get('sizes', [])]
+    }
@@ -0,0 +1,56 @@
+# services/catalog_sync.py
+import asyncio
+import logging
+import time
+from database.db import get_all_users, get_catalog_sync_state, set_catalog_sync_state, load_products, run_db
+from services.wildberries_api import iter_product_cards
+from config.config import CATALOG_SYNC_CONCURRENCY
+
+_sync_locks = {}
+
+
+def _user_lock(user_id):
+    # Ручной /load_products и фоновая синхронизация одного пользователя не должны идти параллельно
+    if user_id not in _sync_locks:
+        _sync_locks[user_id] = asyncio.Lock()
+    return _sync_locks[user_id]
+
+
+async def sync_catalog(user, full=False):
+    """Догружает в локальный каталог карточки, изменённые после сохранённого курсора content API.
+
+    Карточки идут по возрастанию updatedAt; курсор сохраняется после каждой страницы, поэтому
+    прерванная синхронизация продолжается с места сбоя, а следующая получает только изменения.
+    full=True проходит каталог с начала. Возвращает счётчики fetched, inserted, updated, unchanged.
+    Ошибка API (WBApiError) пробрасывается после сохранения уже загруженных страниц.
+    """
+    user_id = user['user_id']
+    totals = {'fetched': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0}
+    async with _user_lock(user_id):
+        started = time.monotonic()
+        state = None if full else await run_db(get_catalog_sync_state, user_id)
+        async for cards, cursor in iter_product_cards(user['wb_token'], cursor=state):
+            counts = await run_db(load_products, user_id, cards)
+            totals['fetched'] += len(cards)
+            for name in ('inserted', 'updated', 'unchanged'):
+                totals[name] += counts[name]
+            if cursor['updatedAt']:
+                await run_db(set_catalog_sync_state, user_id, cursor['updatedAt'], cursor['nmID'])
+        logging.info(f"Catalog sync for user {user_id} ({'full' if full else 'incremental'}): {totals} "
+                     f"in {time.monotonic() - started:.2f}s")
+    return totals
+
+
+async def sync_all_catalogs():
+    """Фоновая задача: догрузка изменённых карточек всех пользователей."""
+    users = await run_db(get_all_users)
+    semaphore = asyncio.Semaphore(CATALOG_SYNC_CONCURRENCY)
+
+    async def sync_user(user):
+        async with semaphore:
+            try:
+                await sync_catalog(user)
+            except Exception as e:
+                logging.error(f"Catalog sync failed for user {user['user_id']}: {e}")
+
+    await asyncio.gather(*(sync_user(user) for user in users))
@@ -0,0 +1,128 @@
+# services/cost_import.py
+import csv
+import logging
+import time
+from itertools import islice
+from database.db import connect, transaction
+from config.config import COST_IMPORT_CHUNK
+
+# Допустимые названия колонок (регистр не важен)
+ARTICLE_COLUMNS = ('article', 'артикул', 'vendorcode', 'sa_name')
+COST_COLUMNS = ('cost', 'purchase_cost', 'себестоимость', 'стоимость', 'закупочная стоимость')
+
+
+class CostImportError(Exception):
+    """Файл не удаётся разобрать целиком (нет нужных колонок, неизвестный формат)."""
+
+
+def _column_index(header, names):
+    normalized = [str(h).strip().lower() if h is not None else '' for h in header]
+    for name in names:
+        if name in normalized:
+            return normalized.index(name)
+    return None
+
+
+def _rows_with_header(rows):
+    """Находит колонки артикула и стоимости по заголовку и отдаёт (номер строки, артикул, стоимость)."""
+    header = next(rows, None)
+    if header is None:
+        raise CostImportError("Файл пуст.")
+    article_idx = _column_index(header, ARTICLE_COLUMNS)
+    cost_idx = _column_index(header, COST_COLUMNS)
+    if article_idx is None or cost_idx is None:
+        raise CostImportError("Не найдены колонки 'article' и 'cost' в первой строке файла.")
+    for line_no, row in enumerate(rows, start=2):
+        if not row or all(value in (None, '') for value in row):
+            continue
+        article = row[article_idx] if article_idx < len(row) else None
+        cost = row[cost_idx] if cost_idx < len(row) else None
+        yield line_no, article, cost
+
+
+def _iter_csv(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        yield from _rows_with_header(csv.reader(f, dialect))
+
+
+def _iter_xlsx(path):
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from _rows_with_header(workbook.active.iter_rows(values_only=True))
+    finally:
+        workbook.close()
+
+
+def iter_cost_rows(path, filename):
+    """Потоково читает файл стоимостей (CSV или XLSX) и отдаёт (номер строки, артикул, стоимость)."""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        return _iter_xlsx(path)
+    if filename.lower().endswith(('.csv', '.txt')):
+        return _iter_csv(path)
+    raise CostImportError("Поддерживаются файлы .csv и .xlsx.")
+
+
+def _validate(line_no, article, cost):
+    """Возвращает (article, cost) или строку с описанием ошибки."""
+    article = str(article).strip().lower() if article is not None else ''
+    if not article:
+        return f"строка {line_no}: пустой артикул"
+    if cost is None or str(cost).strip() == '':
+        return f"строка {line_no}: пустая стоимость"
+    if isinstance(cost, (int, float)):
+        value = float(cost)
+    else:
+        try:
+            value = float(str(cost).strip().replace(' ', '').replace(',', '.'))
+        except ValueError:
+            return f"строка {line_no}: стоимость '{cost}' не является числом"
+    if value < 0 or value != value:
+        return f"строка {line_no}: недопустимая стоимость '{cost}'"
+    return article, value
+
+
+def import_costs(user_id, path, filename, progress=None, chunk_size=COST_IMPORT_CHUNK):
+    """Импортирует закупочные стоимости из файла одной транзакцией, пачками по chunk_size строк.
+
+    Ошибочные строки пропускаются и попадают в result['errors'], импорт при этом продолжается.
+    progress(processed, updated, error_count) вызывается после каждой пачки.
+    Синхронная функция: из asyncio вызывать через run_db.
+    """
+    started = time.monotonic()
+    result = {'processed': 0, 'updated': 0, 'errors': []}
+    rows = iter_cost_rows(path, filename)
+    conn = connect()
+    try:
+        with transaction(conn) as cursor:
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+                valid = []
+                for line_no, article, cost in chunk:
+                    checked = _validate(line_no, article, cost)
+                    if isinstance(checked, str):
+                        result['errors'].append(checked)
+                    else:
+                        valid.append((user_id, checked[0], checked[0], checked[1]))
+                # Новые артикулы создаются с названием = артикул, у существующих меняется только стоимость
+                cursor.executemany(
+                    "INSERT INTO products (user_id, article, name, purchase_cost) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (user_id, article) DO UPDATE SET purchase_cost = excluded.purchase_cost",
+                    valid)
+                result['processed'] += len(chunk)
+                result['updated'] += len(valid)
+                if progress:
+                    progress(result['processed'], result['updated'], len(result['errors']))
+    finally:
+        conn.close()
+    logging.info(f"Cost import for user {user_id} from {filename}: {result['updated']} updated, "
+                 f"{len(result['errors'])} errors in {time.monotonic() - started:.2f}s")
+    return result
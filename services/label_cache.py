@@ -0,0 +1,117 @@
+# services/label_cache.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from config.config import LABEL_CACHE_SIZE, LABEL_CACHE_DIR, LABEL_CACHE_DISK_MAX_MB, LABEL_BARCODE_RENDERER
+
+# Меняется при изменении макета этикетки, чтобы не отдавать PDF старого вида
+LABEL_LAYOUT_VERSION = 2
+
+
+def label_key(sku, product_name, article, brand=None, size=None):
+    """Ключ этикетки: хэш содержимого, от которого зависит PDF."""
+    payload = json.dumps([LABEL_LAYOUT_VERSION, LABEL_BARCODE_RENDERER, str(sku), product_name, article, brand, size],
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LabelCache:
+    """Кэш готовых PDF-этикеток: LRU в памяти и необязательный дисковый уровень с вытеснением по размеру."""
+
+    def __init__(self, max_items=LABEL_CACHE_SIZE, disk_dir=LABEL_CACHE_DIR, disk_max_bytes=LABEL_CACHE_DISK_MAX_MB * 1024 * 1024):
+        self.max_items = max_items
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()
+        self._disk_lock = threading.Lock()
+        self._disk_size = None  # Считается при первом обращении к диску
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def hit_ratio(self):
+        total = sum(self.stats.values())
+        return (self.stats['memory_hits'] + self.stats['disk_hits']) / total if total else 0.0
+
+    def _remember(self, key, data):
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pdf")
+
+    def _scan_disk(self):
+        os.makedirs(self.disk_dir, exist_ok=True)
+        self._disk_size = sum(entry.stat().st_size for entry in os.scandir(self.disk_dir)
+                              if entry.name.endswith('.pdf'))
+
+    def _disk_get(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # Для вытеснения по давности использования
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _disk_put(self, key, data):
+        with self._disk_lock:
+            if self._disk_size is None:
+                self._scan_disk()
+            path = self._disk_path(key)
+            if os.path.exists(path):
+                return
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._disk_size += len(data)
+            if self._disk_size > self.disk_max_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        entries = sorted((entry for entry in os.scandir(self.disk_dir) if entry.name.endswith('.pdf')),
+                         key=lambda entry: entry.stat().st_mtime)
+        # Освобождаем до 90% лимита, чтобы не чистить на каждой записи
+        target = self.disk_max_bytes * 0.9
+        for entry in entries:
+            if self._disk_size <= target:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+                self._disk_size -= size
+            except FileNotFoundError:
+                pass
+        logging.info(f"Label disk cache evicted down to {self._disk_size} bytes")
+
+    async def get(self, key):
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.stats['memory_hits'] += 1
+            return data
+        if self.disk_dir:
+            data = await asyncio.to_thread(self._disk_get, key)
+            if data is not None:
+                self._remember(key, data)
+                self.stats['disk_hits'] += 1
+                return data
+        self.stats['misses'] += 1
+        return None
+
+    async def put(self, key, data):
+        self._remember(key, data)
+        if self.disk_dir:
+            try:
+                await asyncio.to_thread(self._disk_put, key, data)
+            except OSError as e:
+                logging.error(f"Failed to write label to disk cache: {e}")
+
+
+label_cache = LabelCache()
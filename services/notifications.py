@@ -1,39 +1,35 @@
 # services/notifications.py
+import asyncio
 import logging
-from telegram import Bot
-from config.config import BOT_KEY
-from services.wildberries_api import fetch_product_info, get_orders
-from services.barcode_gen import generate_barcode
-from database.db import get_all_users
+from services.wildberries_api import get_orders
+from services.catalog import get_product_details
+from services.barcode_gen import generate_barcode, generate_label_sheet
+from services.telegram_sender import telegram_sender, split_messages
+from database.db import get_all_users, run_db
 
 logging.basicConfig(level=logging.INFO, filename='logs/bot.log', format='%(asctime)s - %(levelname)s - %(message)s')
 
-async def send_notification(order_id: str, task: dict, wb_token: str, chat_id: str) -> None:
-    bot = Bot(token=BOT_KEY)
-    product_info = await fetch_product_info(task.get('article'), wb_token)
+async def build_order_info(order_id, task: dict, wb_token: str, user_id: int) -> dict:
+    """Обогащает заказ данными карточки: текст уведомления и параметры этикетки."""
+    product_info = await get_product_details(user_id, wb_token, task.get('article'), task.get('chrtId'))
     product_name, vendor_code, brand = "Не указано", "Не указано", "Не указано"
     selected_sku, selected_size, photo_link = "Не указано", "Не указано", "Фото отсутствует."
 
-    if product_info and product_info.get('cards'):
-        product = product_info['cards'][0]
-        product_name = product.get('title', product_name)
-        vendor_code = product.get('vendorCode', vendor_code)
-        brand = product.get('brand', brand)
-        sizes = product.get('sizes', [])
+    if product_info:
+        product_name = product_info['title'] or product_name
+        vendor_code = product_info['vendor_code'] or vendor_code
+        brand = product_info['brand'] or brand
         chrt_id = task.get('chrtId')
-        for size in sizes:
-            if size.get('chrtID') == chrt_id:
-                selected_sku = size.get('skus', [''])[0]
-                selected_size = size.get('wbSize', selected_size)
+        for size in product_info['sizes']:
+            if size['chrtID'] == chrt_id:
+                selected_sku = size['sku']
+                selected_size = size['wbSize'] or selected_size
                 break
-        photos = product.get('photos', [])
-        photo_link = photos[0]['big'] if photos else photo_link
+        photo_link = product_info['photo'] or photo_link
 
     price = task.get('salePrice', 0)
     formatted_price = f"{price // 100},{price % 100:02d}"
 
-    pdf_data = await generate_barcode(selected_sku, product_name, vendor_code, brand, selected_size)
-
     message = (
         f"Новый заказ!\n"
         f"ID: {order_id}\n"
@@ -44,25 +40,71 @@ async def send_notification(order_id: str, task: dict, wb_token: str, chat_id: s
         f"Цена: {formatted_price} руб.\n"
         f"Фото: {photo_link}\n"
     )
+    return {'order_id': order_id, 'message': message,
+            'label': (selected_sku, product_name, vendor_code, brand, selected_size)}
+
+
+async def deliver_order_alert(order_id, info: dict, pdf_data, chat_id: str) -> bool:
+    """Отправляет текст уведомления и этикетку через общую очередь отправки.
 
+    Возвращает True, если текст уведомления доставлен (тогда заказ можно считать отправленным).
+    Тексты нескольких заказов, пришедших одновременно, очередь объединяет в одно сообщение.
+    """
+    try:
+        await telegram_sender.send_message(chat_id, info['message'], combine=True)
+    except Exception as e:
+        logging.error(f"Ошибка при отправке уведомления о заказе {order_id}: {e}")
+        return False
     try:
-        await bot.send_message(chat_id=chat_id, text=message)
         if pdf_data:
-            pdf_data.seek(0)
-            await bot.send_document(chat_id=chat_id, document=pdf_data, filename='barcode.pdf', caption="Этикетка с баркодом")
+            await telegram_sender.send_document(chat_id, pdf_data, filename='barcode.pdf',
+                                                caption=f"Этикетка с баркодом, заказ {order_id}")
         else:
-            await bot.send_message(chat_id=chat_id, text="Не удалось сгенерировать этикетку.")
+            await telegram_sender.send_message(chat_id, f"Не удалось сгенерировать этикетку для заказа {order_id}.")
     except Exception as e:
-        logging.error(f"Ошибка при отправке уведомления: {e}")
-        await bot.send_message(chat_id=chat_id, text="Произошла ошибка при обработке заказа.")
+        logging.error(f"Ошибка при отправке этикетки заказа {order_id}: {e}")
+    return True
+
+
+async def send_notification(order_id: str, task: dict, wb_token: str, chat_id: str, user_id: int) -> bool:
+    """Уведомление о заказе целиком: данные карточки, этикетка, отправка. См. deliver_order_alert."""
+    info = await build_order_info(order_id, task, wb_token, user_id)
+    pdf_data = await generate_barcode(*info['label'])
+    return await deliver_order_alert(order_id, info, pdf_data, chat_id)
+
+
+async def send_batch_notification(orders: list, wb_token: str, chat_id: str, user_id: int) -> bool:
+    """Пакетный режим: тексты всех заказов одним сообщением и все этикетки одним многостраничным PDF.
+
+    Возвращает True, если тексты заказов доставлены (тогда весь пакет можно считать отправленным).
+    """
+    infos = await asyncio.gather(*(build_order_info(order['id'], order, wb_token, user_id) for order in orders))
+    pdf_data, pages = await generate_label_sheet([info['label'] for info in infos])
+
+    try:
+        for text in split_messages([info['message'] for info in infos]):
+            await telegram_sender.send_message(chat_id, text)
+    except Exception as e:
+        logging.error(f"Ошибка при отправке пакета уведомлений: {e}")
+        return False
+    try:
+        if pdf_data:
+            await telegram_sender.send_document(chat_id, pdf_data, filename=f'labels_{pages}.pdf',
+                                                caption=f"Этикетки с баркодом: {pages} шт.")
+        if pages < len(infos):
+            await telegram_sender.send_message(chat_id, f"Не удалось сгенерировать этикеток: {len(infos) - pages}.")
+    except Exception as e:
+        logging.error(f"Ошибка при отправке этикеток пакета: {e}")
+    return True
+
 
 async def check_new_orders():
-    users = get_all_users()
+    users = await run_db(get_all_users)
     for user in users:
         try:
             orders = await get_orders(user['wb_token'])
             if orders:
                 for order in orders:
-                    await send_notification(order['id'], order, user['wb_token'], user['chat_id'])
+                    await send_notification(order['id'], order, user['wb_token'], user['chat_id'], user['user_id'])
         except Exception as e:
             logging.error(f"Ошибка при проверке заказов для пользователя {user['user_id']}: {e}")
\ No newline at end of file
@@ -0,0 +1,144 @@
+# services/order_pipeline.py
+import asyncio
+import logging
+import time
+from services.notifications import build_order_info, deliver_order_alert
+from services.barcode_gen import generate_barcode
+from services.sent_orders import sent_orders
+from config.config import ORDER_PIPELINE_QUEUE_SIZE, ORDER_ENRICH_WORKERS, ORDER_RENDER_WORKERS, ORDER_SEND_WORKERS
+
+# Стадии в порядке прохождения заказа
+STAGES = ('enrich', 'render', 'send')
+
+
+class OrderPipeline:
+    """Конвейер уведомлений о заказах: enrich (данные карточки) -> render (этикетка) -> send (Telegram).
+
+    Между стадиями ограниченные очереди: если стадия не успевает, предыдущая ждёт свободного
+    места, а submit — места в первой очереди (обратное давление до цикла опроса).
+    У каждой стадии своё число обработчиков, поэтому сетевые запросы, рендеринг и отправка
+    разных заказов идут одновременно. stats() отдаёт глубину очередей и задержки по стадиям.
+    """
+
+    def __init__(self):
+        self._queues = {}
+        self._workers = []
+        self._in_flight = {}  # (user_id, order_id) -> future, чтобы не отправить заказ дважды
+        self._stats = {stage: {'processed': 0, 'failed': 0, 'busy_time': 0.0, 'max_time': 0.0, 'wait_time': 0.0}
+                       for stage in STAGES}
+
+    def start(self):
+        if self._workers:
+            return
+        self._queues = {stage: asyncio.Queue(maxsize=ORDER_PIPELINE_QUEUE_SIZE) for stage in STAGES}
+        handlers = {'enrich': self._enrich, 'render': self._render, 'send': self._send}
+        counts = {'enrich': ORDER_ENRICH_WORKERS, 'render': ORDER_RENDER_WORKERS, 'send': ORDER_SEND_WORKERS}
+        for index, stage in enumerate(STAGES):
+            next_stage = STAGES[index + 1] if index + 1 < len(STAGES) else None
+            self._workers += [asyncio.create_task(self._worker(stage, next_stage, handlers[stage]))
+                              for _ in range(counts[stage])]
+        logging.info(f"Order pipeline started: {counts}, queue size {ORDER_PIPELINE_QUEUE_SIZE}")
+
+    async def stop(self, timeout=30):
+        """Дожидается заказов, уже попавших в конвейер (не дольше timeout секунд), и останавливает его."""
+        if not self._workers:
+            return
+        try:
+            for stage in STAGES:
+                await asyncio.wait_for(self._queues[stage].join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Order pipeline stopped with unfinished orders: {self.stats()}")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logging.info("Order pipeline stopped")
+
+    async def submit(self, user, order):
+        """Ставит заказ в конвейер. Возвращает future: True, если уведомление доставлено и заказ отмечен."""
+        if not self._workers:
+            self.start()
+        key = (user['user_id'], str(order['id']))
+        if key in self._in_flight:
+            return self._in_flight[key]
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        item = {'user': user, 'order': order, 'future': future, 'queued_at': time.monotonic()}
+        try:
+            await self._queues['enrich'].put(item)
+        except BaseException:
+            # Отмена (например, таймаут опроса) при заполненной очереди: заказ в конвейер не попал,
+            # и следующий цикл опроса должен поставить его заново, а не получить этот future
+            self._in_flight.pop(key, None)
+            future.cancel()
+            raise
+        return future
+
+    async def _worker(self, stage, next_stage, handler):
+        inbox = self._queues[stage]
+        stats = self._stats[stage]
+        while True:
+            item = await inbox.get()
+            started = time.monotonic()
+            stats['wait_time'] += started - item['queued_at']
+            try:
+                await handler(item)
+            except Exception as e:
+                stats['failed'] += 1
+                logging.error(f"Order {item['order'].get('id')} failed at stage {stage}: {e}", exc_info=True)
+                if not item['future'].done():
+                    item['future'].set_result(False)
+                inbox.task_done()
+                continue
+            elapsed = time.monotonic() - started
+            stats['processed'] += 1
+            stats['busy_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            if next_stage:
+                item['queued_at'] = time.monotonic()
+                await self._queues[next_stage].put(item)  # Ждёт, если следующая стадия не успевает
+            inbox.task_done()
+
+    async def _enrich(self, item):
+        order, user = item['order'], item['user']
+        item['info'] = await build_order_info(order['id'], order, user['wb_token'], user['user_id'])
+
+    async def _render(self, item):
+        item['pdf'] = await generate_barcode(*item['info']['label'])
+
+    async def _send(self, item):
+        order, user = item['order'], item['user']
+        delivered = await deliver_order_alert(order['id'], item['info'], item['pdf'], user['chat_id'])
+        if delivered:
+            await sent_orders.mark_sent(user['user_id'], order['id'])
+            logging.info(f"Processed new order ID: {order['id']}")
+        else:
+            logging.warning(f"Order ID {order['id']} not delivered, will retry next cycle")
+        if not item['future'].done():
+            item['future'].set_result(delivered)
+
+    def stats(self):
+        """По стадиям: глубина очереди, обработано, ошибок, средние время ожидания и обработки, максимум."""
+        result = {}
+        for stage in STAGES:
+            stats = self._stats[stage]
+            handled = stats['processed'] + stats['failed']
+            result[stage] = {
+                'depth': self._queues[stage].qsize() if self._queues else 0,
+                'processed': stats['processed'],
+                'failed': stats['failed'],
+                'avg_wait': stats['wait_time'] / handled if handled else 0.0,
+                'avg_time': stats['busy_time'] / stats['processed'] if stats['processed'] else 0.0,
+                'max_time': stats['max_time'],
+            }
+        return result
+
+    def log_stats(self):
+        logging.info("Order pipeline: " + "; ".join(
+            f"{stage} depth {s['depth']}, done {s['processed']}, failed {s['failed']}, "
+            f"wait {s['avg_wait'] * 1000:.0f} ms, work {s['avg_time'] * 1000:.0f} ms (max {s['max_time'] * 1000:.0f} ms)"
+            for stage, s in self.stats().items()))
+
+
+order_pipeline = OrderPipeline()
@@ -0,0 +1,65 @@
+# services/report_cache.py
+import hashlib
+import io
+import json
+import time
+from collections import OrderedDict
+from config.config import REPORT_CACHE_SIZE, REPORT_CACHE_TTL
+
+
+def cost_version(cost_map):
+    """Версия таблицы закупочных стоимостей: хэш её содержимого."""
+    payload = json.dumps(sorted(cost_map.items()), ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+class ReportCache:
+    """LRU-кэш готовых отчётов (текст, Excel, график) с ограничением по времени жизни.
+
+    Ключ — (user_id, date_from, date_to, версия стоимостей), поэтому изменение стоимостей
+    само по себе даёт промах; invalidate(user_id) дополнительно освобождает записи пользователя.
+    """
+
+    def __init__(self, max_items=REPORT_CACHE_SIZE, ttl=REPORT_CACHE_TTL):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def hit_ratio(self):
+        total = sum(self.stats.values())
+        return self.stats['hits'] / total if total else 0.0
+
+    def get(self, key, chart=False):
+        """Отчёт по ключу (excel и chart — новые BytesIO) или None. При chart=True нужен отчёт с графиком."""
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry['stored_at'] > self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None or (chart and not entry['with_chart']):
+            self.stats['misses'] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats['hits'] += 1
+        report = dict(entry['report'])
+        for name in ('excel', 'chart'):
+            if report[name] is not None:
+                report[name] = io.BytesIO(report[name])
+        return report
+
+    def put(self, key, report, chart=False):
+        stored = dict(report)
+        for name in ('excel', 'chart'):
+            if stored[name] is not None:
+                stored[name] = stored[name].getvalue()
+        self._entries[key] = {'report': stored, 'with_chart': chart, 'stored_at': time.monotonic()}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        for key in [key for key in self._entries if key[0] == user_id]:
+            del self._entries[key]
+
+
+report_cache = ReportCache()
@@ -0,0 +1,101 @@
+# services/report_renderer.py
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+
+matplotlib.use("Agg")  # Без GUI: графики строятся в фоновых процессах
+
+from utils.messages import generate_sales_excel, generate_sales_chart, sales_report_message
+from config.config import REPORT_RENDER_WORKERS, REPORT_QUEUE_LIMIT
+
+logging.basicConfig(
+    level=logging.INFO,
+    filename='logs/bot.log',
+    encoding='utf-8',  # Явно указываем UTF-8
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+_report_executor = None
+_pending = 0
+report_stats = {'count': 0, 'failed': 0, 'rejected': 0, 'render_time': 0.0, 'total_time': 0.0, 'max_total_time': 0.0}
+
+
+class ReportQueueFull(Exception):
+    """Очередь построения отчётов заполнена."""
+
+
+def _get_report_executor():
+    global _report_executor
+    if _report_executor is None:
+        # spawn: дочерние процессы не наследуют потоки и соединения бота
+        _report_executor = ProcessPoolExecutor(max_workers=REPORT_RENDER_WORKERS,
+                                               mp_context=multiprocessing.get_context("spawn"))
+        logging.info(f"Report render pool started: {REPORT_RENDER_WORKERS} workers")
+    return _report_executor
+
+
+def shutdown_report_pool():
+    global _report_executor
+    if _report_executor is not None:
+        _report_executor.shutdown(wait=True)
+        _report_executor = None
+        logging.info("Report render pool stopped")
+
+
+def build_sales_report(sales_data, stock_data, transit_data, date_from, date_to, user_id, cost_map, daily=None,
+                       chart=False):
+    """Строит Excel (и при chart=True график) в процессе пула.
+
+    Возвращает ({'excel', 'excel_name', 'chart', 'chart_name', 'text'} или None, время построения в секундах).
+    excel и chart — BytesIO (или None); в основной процесс возвращаются только они и текст, а не строки отчёта.
+    """
+    started = time.monotonic()
+    excel, metrics = generate_sales_excel(sales_data, stock_data, transit_data, date_from, date_to, user_id,
+                                          cost_map, daily)
+    if not metrics:
+        return None, time.monotonic() - started
+    text, _ = sales_report_message(metrics, user_id)
+    chart_png = None
+    if chart:
+        chart_png = generate_sales_chart(sales_data, stock_data, date_from, date_to, user_id, cost_map, daily,
+                                         metrics['frame'])
+    report = {'excel': excel, 'excel_name': f"sales_report_{date_from}_{date_to}.xlsx",
+              'chart': chart_png, 'chart_name': f"sales_chart_{date_from}_{date_to}.png", 'text': text}
+    return report, time.monotonic() - started
+
+
+async def render_sales_report(sales_data, stock_data, transit_data, date_from, date_to, user_id, cost_map, daily=None,
+                              chart=False):
+    """Строит отчёт в пуле процессов, не блокируя event loop. Результат — как у build_sales_report.
+
+    Если в очереди уже REPORT_QUEUE_LIMIT отчётов, сразу бросает ReportQueueFull.
+    """
+    global _pending
+    if _pending >= REPORT_QUEUE_LIMIT:
+        report_stats['rejected'] += 1
+        raise ReportQueueFull(f"{_pending} reports already queued")
+
+    _pending += 1
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+    try:
+        report, render_time = await loop.run_in_executor(
+            _get_report_executor(), build_sales_report, sales_data, stock_data, transit_data, date_from, date_to,
+            user_id, cost_map, daily, chart)
+    except Exception:
+        report_stats['failed'] += 1
+        raise
+    finally:
+        _pending -= 1
+    total_time = time.monotonic() - started
+    report_stats['count'] += 1
+    report_stats['render_time'] += render_time
+    report_stats['total_time'] += total_time
+    report_stats['max_total_time'] = max(report_stats['max_total_time'], total_time)
+    logging.info(f"Sales report {date_from} - {date_to} for user {user_id} rendered in {render_time:.2f}s "
+                 f"(with queue wait {total_time:.2f}s, queued now {_pending}, "
+                 f"avg {report_stats['total_time'] / report_stats['count']:.2f}s)")
+    return report
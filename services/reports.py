@@ -0,0 +1,36 @@
+# services/reports.py
+import asyncio
+import logging
+from database.db import get_cost_map, get_sales_daily, run_db
+from services.wildberries_api import get_orders_in_transit, get_stock_data
+from services.sales_ledger import get_sales_data
+from services.report_renderer import render_sales_report
+from services.report_cache import report_cache, cost_version
+
+
+async def get_user_report(user, date_from, date_to, chart=False):
+    """Готовый отчёт по продажам пользователя за период (см. build_sales_report) или None.
+
+    Повторный запрос того же периода при неизменных стоимостях берётся из report_cache
+    без обращений к API и без перестроения. ReportQueueFull пробрасывается вызывающему.
+    """
+    user_id = user['user_id']
+    cost_map = await run_db(get_cost_map, user_id)
+    key = (user_id, date_from, date_to, cost_version(cost_map))
+    report = report_cache.get(key, chart)
+    if report is not None:
+        logging.info(f"Report cache hit for user {user_id} {date_from} - {date_to} "
+                     f"(hit ratio {report_cache.hit_ratio():.0%})")
+        return report
+
+    # Три источника независимы: запрашиваем одновременно
+    sales_data, stock_data, transit_data = await asyncio.gather(
+        get_sales_data(user, date_from, date_to),
+        get_stock_data(date_from, user['wb_token']),
+        get_orders_in_transit(user['wb_token']))
+    daily = await run_db(get_sales_daily, user_id, date_from, date_to)
+    report = await render_sales_report(sales_data, stock_data, transit_data, date_from, date_to, user_id, cost_map,
+                                       daily, chart)
+    if report is not None:
+        report_cache.put(key, report, chart)
+    return report
@@ -0,0 +1,106 @@
+# services/sales_ledger.py
+import asyncio
+import logging
+import sqlite3
+import time
+from datetime import date, timedelta
+from database.db import (get_all_users, get_sales_rows, get_sales_sync_state, insert_sales_rows,
+                         set_sales_sync_state, run_db)
+from services.wildberries_api import iter_sales_report, WBApiError
+from config.config import SALES_LEDGER_INITIAL_DAYS, SALES_SYNC_OVERLAP_DAYS, SALES_SYNC_MIN_INTERVAL, \
+    SALES_SYNC_CONCURRENCY
+
+_sync_locks = {}
+
+
+def _user_lock(user_id):
+    # Ручной отчёт и фоновая синхронизация одного пользователя не должны качать одно и то же параллельно
+    if user_id not in _sync_locks:
+        _sync_locks[user_id] = asyncio.Lock()
+    return _sync_locks[user_id]
+
+
+def _shift(day: str, days: int) -> str:
+    return (date.fromisoformat(day[:10]) + timedelta(days=days)).isoformat()
+
+
+async def _load_range(user, date_from, date_to, rrdid=0, on_page=None):
+    """Загружает строки отчёта за период в sales_ledger постранично. Возвращает (новых строк, последняя строка)."""
+    inserted, last_row = 0, None
+    async for page in iter_sales_report(date_from, date_to, user['wb_token'], rrdid=rrdid):
+        inserted += await run_db(insert_sales_rows, user['user_id'], page)
+        page_last = max(page, key=lambda row: row.get('rrd_id') or 0)
+        if last_row is None or (page_last.get('rrd_id') or 0) > (last_row.get('rrd_id') or 0):
+            last_row = page_last
+        if on_page:
+            await on_page(last_row)
+    return inserted, last_row
+
+
+async def sync_sales_ledger(user, date_from=None, force=False):
+    """Догружает в локальный журнал продаж только новые строки отчёта реализации.
+
+    Первая синхронизация берёт SALES_LEDGER_INITIAL_DAYS дней (или с date_from). Дальше запрос идёт
+    от даты последней строки (с перекрытием SALES_SYNC_OVERLAP_DAYS) и rrdid последней строки.
+    Если нужен период раньше уже загруженного, он догружается отдельно. Прогресс сохраняется после
+    каждой страницы, поэтому прерванная синхронизация продолжается с того же места.
+    Возвращает число новых строк.
+    """
+    user_id = user['user_id']
+    today = date.today().isoformat()
+    async with _user_lock(user_id):
+        started = time.monotonic()
+        state = await run_db(get_sales_sync_state, user_id)
+        inserted = 0
+        if state is None:
+            synced_from = min(date_from or today, _shift(today, -SALES_LEDGER_INITIAL_DAYS))
+            state = {'synced_from': synced_from, 'last_rrd_id': 0, 'last_rr_dt': synced_from, 'synced_at': None}
+            force = True
+
+        if date_from and date_from < state['synced_from']:
+            # Период раньше начала журнала: догружаем его целиком один раз
+            backfilled, _ = await _load_range(user, date_from, _shift(state['synced_from'], -1))
+            inserted += backfilled
+            state['synced_from'] = date_from
+            await run_db(set_sales_sync_state, user_id, state['synced_from'], state['last_rrd_id'], state['last_rr_dt'])
+
+        if not force and state['synced_at'] and time.time() - state['synced_at'] < SALES_SYNC_MIN_INTERVAL:
+            return inserted
+
+        async def save_progress(last_row):
+            state['last_rrd_id'] = last_row.get('rrd_id') or state['last_rrd_id']
+            state['last_rr_dt'] = max(state['last_rr_dt'] or '', (last_row.get('rr_dt') or '')[:10])
+            await run_db(set_sales_sync_state, user_id, state['synced_from'], state['last_rrd_id'], state['last_rr_dt'])
+
+        delta_from = max(state['synced_from'], _shift(state['last_rr_dt'], -SALES_SYNC_OVERLAP_DAYS))
+        delta, _ = await _load_range(user, delta_from, today, rrdid=state['last_rrd_id'] or 0, on_page=save_progress)
+        inserted += delta
+        # Отметка времени синхронизации, даже если новых строк не было
+        await run_db(set_sales_sync_state, user_id, state['synced_from'], state['last_rrd_id'], state['last_rr_dt'])
+        logging.info(f"Sales ledger sync for user {user_id}: {inserted} new rows from {delta_from} "
+                     f"in {time.monotonic() - started:.2f}s")
+        return inserted
+
+
+async def get_sales_data(user, date_from, date_to):
+    """Строки отчёта реализации за период из локального журнала; из API догружается только дельта."""
+    try:
+        await sync_sales_ledger(user, date_from)
+    except (WBApiError, sqlite3.Error) as e:
+        logging.error(f"Sales ledger sync failed for user {user['user_id']}, using local data: {e}")
+    return await run_db(get_sales_rows, user['user_id'], date_from, date_to)
+
+
+async def sync_all_sales_ledgers():
+    """Фоновая задача: синхронизация журналов продаж всех пользователей."""
+    users = await run_db(get_all_users)
+    semaphore = asyncio.Semaphore(SALES_SYNC_CONCURRENCY)
+
+    async def sync_user(user):
+        async with semaphore:
+            try:
+                await sync_sales_ledger(user, force=True)
+            except Exception as e:
+                logging.error(f"Sales ledger sync failed for user {user['user_id']}: {e}")
+
+    await asyncio.gather(*(sync_user(user) for user in users))
@@ -1,12 +1,19 @@
 # services/scheduler.py
+import asyncio
 import logging
+import time
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from services.notifications import send_notification
-from services.wildberries_api import get_orders, get_sales_report, get_orders_in_transit, get_stock_data
-from database.db import get_all_users
-from utils.messages import sales_report_message, generate_sales_excel, generate_sales_chart
-from telegram import Bot
-from config.config import BOT_KEY, CHAT_ID
+from services.notifications import send_batch_notification
+from services.order_pipeline import order_pipeline
+from services.wildberries_api import get_orders
+from services.sales_ledger import sync_all_sales_ledgers
+from services.catalog_sync import sync_all_catalogs
+from database.db import get_all_users, run_db
+from services.sent_orders import sent_orders
+from services.reports import get_user_report
+from services.telegram_sender import telegram_sender, PRIORITY_REPORT
+from config.config import CHAT_ID, CHECK_INTERVAL, POLL_CONCURRENCY, POLL_USER_TIMEOUT, LABEL_BATCH_MODE, \
+    SALES_SYNC_INTERVAL_HOURS, WEEKLY_REPORT_CONCURRENCY, CATALOG_SYNC_INTERVAL_HOURS
 from datetime import datetime, timedelta
 
 logging.basicConfig(
@@ -17,29 +24,90 @@ logging.basicConfig(
 )
 
 scheduler = AsyncIOScheduler()
-sent_orders = set()  # Множество для хранения отправленных заказов
 
-async def check_for_new_orders():
-    users = get_all_users()
-    for user in users:
+async def process_user_orders(user):
+    """Проверяет новые заказы одного пользователя и отправляет уведомления."""
+    orders = await get_orders(user['wb_token'])  # Теперь get_orders доступна
+    if orders:
+        new_order_ids = await sent_orders.filter_new(user['user_id'], [order['id'] for order in orders])
+        new_orders = [order for order in orders if str(order['id']) in new_order_ids]
+        if LABEL_BATCH_MODE and len(new_orders) > 1:
+            # Пакетный режим: одно сообщение и один PDF со всеми этикетками за цикл
+            if not await send_batch_notification(new_orders, user['wb_token'], user['chat_id'], user['user_id']):
+                logging.warning(f"Batch of {len(new_orders)} orders for user {user['user_id']} not delivered, "
+                                f"will retry next cycle")
+                return
+            for order in new_orders:
+                await sent_orders.mark_sent(user['user_id'], order['id'])
+            logging.info(f"Processed {len(new_orders)} new orders in batch for user {user['user_id']}")
+            return
+
+        # Заказы уходят в конвейер сразу; submit ждёт только при заполненной очереди (обратное давление)
+        deliveries = [await order_pipeline.submit(user, order) for order in new_orders]
+        if deliveries:
+            # wait, а не gather: при таймауте опроса заказы в конвейере не отменяются и будут доставлены
+            await asyncio.wait(deliveries)
+        logging.info(f"{len(orders) - len(new_orders)} orders already processed, skipped.")
+
+
+async def _poll_user(user, semaphore):
+    async with semaphore:
         try:
-            orders = await get_orders(user['wb_token'])  # Теперь get_orders доступна
-            if orders:
-                for order in orders:
-                    order_id = order['id']
-                    if order_id not in sent_orders:  # Проверяем, отправляли ли уже
-                        await send_notification(order_id, order, user['wb_token'], user['chat_id'])
-                        sent_orders.add(order_id)  # Добавляем в отправленные
-                        logging.info(f"Processed new order ID: {order_id}")
-                    else:
-                        logging.info(f"Order ID {order_id} already processed, skipping.")
+            await asyncio.wait_for(process_user_orders(user), timeout=POLL_USER_TIMEOUT)
+            return True
+        except asyncio.TimeoutError:
+            logging.error(f"Таймаут ({POLL_USER_TIMEOUT} с) при проверке заказов для пользователя {user['user_id']}")
         except Exception as e:
             logging.error(f"Ошибка при проверке заказов для пользователя {user['user_id']}: {e}")
+        return False
+
+
+async def check_for_new_orders():
+    started = time.monotonic()
+    users = await run_db(get_all_users)
+    semaphore = asyncio.Semaphore(POLL_CONCURRENCY)
+    # Ошибки одного пользователя не влияют на остальных: _poll_user их перехватывает
+    results = await asyncio.gather(*(_poll_user(user, semaphore) for user in users))
+    elapsed = time.monotonic() - started
+    failed = results.count(False)
+    logging.info(f"Order poll cycle finished in {elapsed:.2f}s: {len(users)} users, {failed} failed, "
+                 f"concurrency {POLL_CONCURRENCY}")
+    order_pipeline.log_stats()
+    if elapsed > CHECK_INTERVAL:
+        logging.warning(f"Order poll cycle took {elapsed:.2f}s, longer than the {CHECK_INTERVAL}s interval")
+
+
+async def _weekly_user_report(user, date_from, date_to, semaphore):
+    async with semaphore:
+        started = time.monotonic()
+        try:
+            report = await get_user_report(user, date_from, date_to, chart=True)
+            if report is None:
+                await telegram_sender.send_message(
+                    CHAT_ID, f"Еженедельный отчёт ({date_from} - {date_to}): Не удалось сгенерировать из-за отсутствия данных.",
+                    priority=PRIORITY_REPORT)
+                return False
+
+            await telegram_sender.send_message(
+                CHAT_ID, f"Еженедельный отчёт по продажам ({date_from} - {date_to}):\n{report['text']}",
+                priority=PRIORITY_REPORT)
+            if report['excel']:
+                await telegram_sender.send_document(CHAT_ID, report['excel'], filename=report['excel_name'],
+                                                    priority=PRIORITY_REPORT)
+            if report['chart']:
+                await telegram_sender.send_photo(CHAT_ID, report['chart'], filename=report['chart_name'],
+                                                 priority=PRIORITY_REPORT)
+            logging.info(f"Weekly report for user {user['user_id']} sent in {time.monotonic() - started:.2f}s")
+            return True
+        except Exception as e:
+            logging.error(f"Error in weekly sales report for user {user['user_id']} "
+                          f"after {time.monotonic() - started:.2f}s: {e}")
+            return False
 
 
 async def weekly_sales_report():
-    bot = Bot(token=BOT_KEY)
-    users = get_all_users()
+    started = time.monotonic()
+    users = await run_db(get_all_users)
     if not users:
         logging.warning("No users found for weekly report.")
         return
@@ -47,35 +115,17 @@ async def weekly_sales_report():
     date_to = datetime.now().strftime('%Y-%m-%d')
     date_from = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
 
-    for user in users:
-        try:
-            sales_data = await get_sales_report(date_from, date_to, user['wb_token'])
-            stock_data = await get_stock_data(date_from, user['wb_token'])
-            transit_data = await get_orders_in_transit(user['wb_token'])
-
-            result = generate_sales_excel(sales_data, stock_data, transit_data, date_from, date_to, user['user_id'])
-            if result is None:
-                await bot.send_message(chat_id=CHAT_ID,
-                                       text=f"Еженедельный отчёт ({date_from} - {date_to}): Не удалось сгенерировать из-за отсутствия данных.")
-                continue
-
-            excel_file, metrics = result
-            text, _ = sales_report_message(metrics, user['user_id'])
-            chart_file = generate_sales_chart(sales_data, stock_data, date_from, date_to)
-
-            await bot.send_message(chat_id=CHAT_ID,
-                                   text=f"Еженедельный отчёт по продажам ({date_from} - {date_to}):\n{text}")
-            if excel_file:
-                with open(excel_file, 'rb') as f:
-                    await bot.send_document(chat_id=CHAT_ID, document=f, filename=excel_file)
-            if chart_file:
-                with open(chart_file, 'rb') as f:
-                    await bot.send_photo(chat_id=CHAT_ID, photo=f, filename=chart_file)
-        except Exception as e:
-            logging.error(f"Error in weekly sales report for user {user['user_id']}: {e}")
+    semaphore = asyncio.Semaphore(WEEKLY_REPORT_CONCURRENCY)
+    results = await asyncio.gather(*(_weekly_user_report(user, date_from, date_to, semaphore) for user in users))
+    logging.info(f"Weekly report run finished in {time.monotonic() - started:.2f}s: {len(users)} users, "
+                 f"{results.count(False)} without report, concurrency {WEEKLY_REPORT_CONCURRENCY}")
 
 async def start_scheduler(context=None):
     logging.info("Starting scheduler...")
-    scheduler.add_job(check_for_new_orders, 'interval', seconds=120)
+    scheduler.add_job(check_for_new_orders, 'interval', seconds=CHECK_INTERVAL, max_instances=1, coalesce=True)
+    scheduler.add_job(sent_orders.purge, 'interval', hours=24)
+    scheduler.add_job(sync_all_sales_ledgers, 'interval', hours=SALES_SYNC_INTERVAL_HOURS, max_instances=1,
+                      next_run_time=datetime.now())
+    scheduler.add_job(sync_all_catalogs, 'interval', hours=CATALOG_SYNC_INTERVAL_HOURS, max_instances=1)
     scheduler.add_job(weekly_sales_report, 'cron', day_of_week='mon', hour=9, minute=0)  # Понедельник, 09:00
     scheduler.start()
\ No newline at end of file
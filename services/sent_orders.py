@@ -0,0 +1,65 @@
+# services/sent_orders.py
+import logging
+import time
+from collections import OrderedDict
+from database.db import get_sent_orders, mark_order_sent, purge_sent_orders, run_db
+from config.config import SENT_ORDERS_TTL_DAYS, SENT_ORDERS_CACHE_SIZE
+
+
+class SentOrdersStore:
+    """Хранилище уже отправленных заказов: таблица sent_orders в users.db и небольшой LRU-кэш перед ней.
+
+    Ключ — (user_id, order_id). Записи старше ttl удаляются методом purge(),
+    поэтому ни таблица, ни память не растут бесконечно, а после перезапуска
+    бот не отправляет уведомления повторно.
+    """
+
+    def __init__(self, ttl_seconds=SENT_ORDERS_TTL_DAYS * 86400, cache_size=SENT_ORDERS_CACHE_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # (user_id, order_id) -> sent_at
+
+    def _remember(self, key, sent_at):
+        self._cache[key] = sent_at
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def filter_new(self, user_id, order_ids):
+        """Возвращает множество order_id, по которым уведомление ещё не отправлялось."""
+        now = time.time()
+        unknown = []
+        for order_id in order_ids:
+            key = (user_id, str(order_id))
+            sent_at = self._cache.get(key)
+            if sent_at is not None and now - sent_at < self.ttl_seconds:
+                self._cache.move_to_end(key)
+            else:
+                unknown.append(str(order_id))
+        if not unknown:
+            return set()
+        already_sent = await run_db(get_sent_orders, user_id, unknown)
+        for order_id, sent_at in already_sent.items():
+            self._remember((user_id, order_id), sent_at)
+        return set(unknown) - already_sent.keys()
+
+    async def is_sent(self, user_id, order_id):
+        return not await self.filter_new(user_id, [order_id])
+
+    async def mark_sent(self, user_id, order_id):
+        now = time.time()
+        await run_db(mark_order_sent, user_id, order_id, now)
+        self._remember((user_id, str(order_id)), now)
+
+    async def purge(self):
+        """Удаляет записи старше ttl из таблицы и кэша."""
+        cutoff = time.time() - self.ttl_seconds
+        deleted = await run_db(purge_sent_orders, cutoff)
+        expired = [key for key, sent_at in self._cache.items() if sent_at < cutoff]
+        for key in expired:
+            del self._cache[key]
+        logging.info(f"Purged {deleted} sent order records older than {SENT_ORDERS_TTL_DAYS} days")
+        return deleted
+
+
+sent_orders = SentOrdersStore()
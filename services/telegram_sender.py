@@ -0,0 +1,253 @@
+# services/telegram_sender.py
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import timedelta
+from telegram import Bot
+from telegram.error import RetryAfter, NetworkError, BadRequest
+from utils.rate_limit import TokenBucket
+from config.config import BOT_KEY, TELEGRAM_MESSAGE_LIMIT, TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, \
+    TELEGRAM_CHAT_BURST, TELEGRAM_SENDER_WORKERS, TELEGRAM_SEND_ATTEMPTS
+
+# Меньше — раньше: уведомления о заказах обгоняют отчёты
+PRIORITY_ORDER = 0
+PRIORITY_REPORT = 10
+
+
+def split_messages(messages, limit=TELEGRAM_MESSAGE_LIMIT, separator="\n"):
+    """Склеивает тексты в как можно меньшее число сообщений не длиннее limit символов."""
+    chunks, current = [], ""
+    for message in messages:
+        candidate = f"{current}{separator}{message}" if current else message
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            chunks.append(current)
+        current = message[:limit]
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class TelegramSender:
+    """Единая очередь исходящих сообщений бота.
+
+    У каждого чата своя очередь заданий (по приоритету, в пределах приоритета — по порядку), а
+    обработчикам выдаются готовые к отправке чаты. Чат, который упёрся в свой лимит или получил
+    flood wait (RetryAfter), откладывается таймером и не занимает обработчик, поэтому очередь
+    одного чата не задерживает остальные. Одно задание — один вызов Bot API; при flood wait и
+    сетевых ошибках оно возвращается в голову очереди чата и повторяется.
+    Тексты с combine=True, скопившиеся для чата, пока он ждал своей очереди, уходят одним сообщением.
+    Методы send_* ждут фактической отправки и пробрасывают ошибку, если она не удалась.
+    """
+
+    def __init__(self):
+        self.bot = None
+        self._ready = None  # (priority, seq, chat_id) — чаты, которые можно обслужить сейчас
+        self._workers = []
+        self._sequence = itertools.count()
+        self._global_limit = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._chat_limits = {}
+        self._chat_jobs = {}  # chat_id -> куча (priority, seq, part, job)
+        self._scheduled = set()  # Чаты в _ready, под таймером или в работе: у чата не больше одного обработчика
+        self._idle = asyncio.Event()
+        self._pending_texts = {}  # (chat_id, priority) -> [(text, future)], ещё не отправленные тексты
+        self.stats = {'sent': 0, 'combined': 0, 'retries': 0, 'failed': 0}
+
+    async def start(self, bot=None):
+        if self._workers:
+            return
+        self.bot = bot or self.bot or Bot(token=BOT_KEY)
+        self._ready = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(TELEGRAM_SENDER_WORKERS)]
+        logging.info(f"Telegram sender started: {TELEGRAM_SENDER_WORKERS} workers")
+
+    async def stop(self, timeout=10):
+        """Дожидается отправки очереди (не дольше timeout секунд) и останавливает отправителей."""
+        if not self._workers:
+            return
+        try:
+            if self._chat_jobs:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            queued = sum(len(jobs) for jobs in self._chat_jobs.values())
+            logging.warning(f"Telegram sender stopped with {queued} jobs still queued")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logging.info(f"Telegram sender stopped: {self.stats}")
+
+    def _chat_limit(self, chat_id):
+        if chat_id not in self._chat_limits:
+            self._chat_limits[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        return self._chat_limits[chat_id]
+
+    def _push(self, chat_id, key, job):
+        """Кладёт задание в очередь чата; свободный чат сразу ставится в расписание."""
+        heapq.heappush(self._chat_jobs.setdefault(chat_id, []), (*key, job))
+        self._idle.clear()
+        if chat_id not in self._scheduled:
+            self._schedule(chat_id)
+
+    def _schedule(self, chat_id):
+        """Отдаёт чат обработчикам, как только у него появится токен; пустой чат снимается с учёта."""
+        if not self._chat_jobs.get(chat_id):
+            self._chat_jobs.pop(chat_id, None)
+            self._scheduled.discard(chat_id)
+            if not self._chat_jobs:
+                self._idle.set()
+            return
+        self._scheduled.add(chat_id)
+        wait = self._chat_limit(chat_id).delay()
+        if wait:
+            asyncio.get_running_loop().call_later(wait, self._make_ready, chat_id)
+        else:
+            self._make_ready(chat_id)
+
+    def _make_ready(self, chat_id):
+        priority, seq = self._chat_jobs[chat_id][0][:2]
+        self._ready.put_nowait((priority, seq, chat_id))
+
+    async def _put(self, priority, chat_id, call):
+        """Ставит вызов Bot API в очередь чата и возвращает future с его результатом."""
+        if not self._workers:
+            # Вне бота (скрипты, ручной запуск) очередь поднимается при первой отправке
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._push(chat_id, (priority, next(self._sequence), 0), {'call': call, 'future': future, 'attempt': 1})
+        return future
+
+    async def _enqueue(self, priority, chat_id, call):
+        return await (await self._put(priority, chat_id, call))
+
+    async def _worker(self):
+        while True:
+            _, _, chat_id = await self._ready.get()
+            try:
+                await self._run_next(chat_id)
+            finally:
+                self._schedule(chat_id)
+                self._ready.task_done()
+
+    async def _run_next(self, chat_id):
+        """Выполняет первое задание чата. Лимит чата не ждёт: если токена нет, чат уходит под таймер."""
+        jobs = self._chat_jobs[chat_id]
+        priority, seq, part, job = jobs[0]
+        if 'texts' in job:
+            heapq.heappop(jobs)
+            self._expand_texts(chat_id, priority, seq, job['texts'])
+            return
+        if job['future'].done():
+            heapq.heappop(jobs)  # Отправитель больше не ждёт (отмена или ошибка предыдущей части текста)
+            return
+        limit = self._chat_limit(chat_id)
+        if not limit.try_acquire():
+            return
+        heapq.heappop(jobs)
+        await self._global_limit.acquire()
+        try:
+            result = await job['call']()
+        except RetryAfter as e:
+            if job['attempt'] == TELEGRAM_SEND_ATTEMPTS:
+                self._fail(job, e)
+                return
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            limit.block_for(delay)
+            logging.warning(f"Telegram flood wait {delay:.0f}s for chat {chat_id}, attempt {job['attempt']}")
+            self._retry(jobs, priority, seq, part, job)
+        except BadRequest as e:
+            self._fail(job, e)
+        except NetworkError as e:
+            if job['attempt'] == TELEGRAM_SEND_ATTEMPTS:
+                self._fail(job, e)
+                return
+            logging.warning(f"Telegram network error for chat {chat_id}: {e}, attempt {job['attempt']}")
+            limit.block_for(2 ** job['attempt'])
+            self._retry(jobs, priority, seq, part, job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.stats['sent'] += 1
+            if not job['future'].done():
+                job['future'].set_result(result)
+
+    def _retry(self, jobs, priority, seq, part, job):
+        # Задание возвращается в голову очереди чата: порядок сообщений в чате сохраняется
+        job['attempt'] += 1
+        self.stats['retries'] += 1
+        heapq.heappush(jobs, (priority, seq, part, job))
+
+    def _fail(self, job, error):
+        self.stats['failed'] += 1
+        if not job['future'].done():
+            job['future'].set_exception(error)
+        for future in job.get('batch', ()):
+            future.cancel()  # Остальные части склеенного текста после ошибки не отправляются
+
+    async def send_message(self, chat_id, text, priority=PRIORITY_ORDER, combine=False):
+        if not combine:
+            return await self._enqueue(priority, chat_id, lambda: self.bot.send_message(chat_id=chat_id, text=text))
+        key = (chat_id, priority)
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending_texts.get(key)
+        if pending is not None:
+            # Для чата уже стоит отправка в очереди: текст уйдёт вместе с ней
+            pending.append((text, future))
+            return await future
+        self._pending_texts[key] = [(text, future)]
+        if not self._workers:
+            await self.start()
+        # Метка в очереди чата: когда до неё дойдёт очередь, накопленные тексты склеиваются в сообщения
+        self._push(chat_id, (priority, next(self._sequence), 0), {'texts': key})
+        return await future
+
+    def _expand_texts(self, chat_id, priority, seq, key):
+        """Склеивает накопленные тексты и ставит получившиеся сообщения на место метки в очереди чата."""
+        pending = self._pending_texts.pop(key, [])
+        texts = [text for text, _ in pending]
+        if len(texts) > 1:
+            self.stats['combined'] += len(texts) - 1
+            logging.info(f"Combining {len(texts)} messages for chat {chat_id}")
+        loop = asyncio.get_running_loop()
+        chunk_futures = []
+        for part, chunk in enumerate(split_messages(texts), start=1):
+            future = loop.create_future()
+            heapq.heappush(self._chat_jobs[chat_id], (priority, seq, part, {
+                'call': lambda chunk=chunk: self.bot.send_message(chat_id=chat_id, text=chunk),
+                'future': future, 'attempt': 1, 'batch': chunk_futures}))
+            chunk_futures.append(future)
+
+        def resolve(done):
+            # Результат получает каждый отправитель текста через свой future
+            for _, future in pending:
+                if future.done():
+                    continue
+                if done.cancelled():
+                    future.cancel()
+                elif done.exception():
+                    future.set_exception(done.exception())
+                else:
+                    future.set_result(None)
+
+        asyncio.gather(*chunk_futures).add_done_callback(resolve)
+
+    async def send_document(self, chat_id, document, filename, caption=None, priority=PRIORITY_ORDER):
+        async def call():
+            document.seek(0)  # При повторе файл читается заново
+            return await self.bot.send_document(chat_id=chat_id, document=document, filename=filename,
+                                                caption=caption)
+        return await self._enqueue(priority, chat_id, call)
+
+    async def send_photo(self, chat_id, photo, filename, caption=None, priority=PRIORITY_ORDER):
+        async def call():
+            photo.seek(0)
+            return await self.bot.send_photo(chat_id=chat_id, photo=photo, filename=filename, caption=caption)
+        return await self._enqueue(priority, chat_id, call)
+
+
+telegram_sender = TelegramSender()
@@ -1,8 +1,16 @@
 # services/wildberries_api.py
+import asyncio
 import logging
+import random
+from contextlib import asynccontextmanager
 import aiohttp
 from aiohttp import ClientTimeout
-from config.config import API_KEY, BASE_URL, CONTENT_URL
+from yarl import URL
+from utils.rate_limit import TokenBucket
+from config.config import API_KEY, BASE_URL, CONTENT_URL, WB_CONNECTION_LIMIT, WB_CONNECTION_LIMIT_PER_HOST, \
+    WB_DNS_CACHE_TTL, WB_KEEPALIVE_TIMEOUT, WB_REQUEST_TIMEOUT, SALES_REPORT_PAGE_LIMIT, SALES_REPORT_PAGE_TIMEOUT, \
+    SALES_REPORT_PAGE_RETRIES, SALES_REPORT_RETRY_DELAY, WB_RATE_LIMITS, WB_DEFAULT_RATE_LIMIT, WB_RETRY_ATTEMPTS, \
+    WB_RETRY_BASE_DELAY, WB_RETRY_MAX_DELAY, CATALOG_PAGE_TIMEOUT
 from datetime import datetime, timedelta
 
 logging.basicConfig(
@@ -12,70 +20,214 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# Поля сборочного задания, которые нужны листу «В пути»
+TRANSIT_FIELDS = ('id', 'article', 'createdAt', 'offices')
+
+
+# Ответы, после которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class WBApiError(Exception):
+    """Запрос к API Wildberries не удался после всех повторов."""
+
+
+def _retry_after(response):
+    """Пауза из Retry-After (или X-Ratelimit-Retry) в секундах, None если заголовка нет."""
+    value = response.headers.get('Retry-After') or response.headers.get('X-Ratelimit-Retry')
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _backoff_delay(attempt, base):
+    """Экспоненциальная задержка с джиттером: от половины до полной паузы base * 2^(attempt-1)."""
+    delay = min(WB_RETRY_MAX_DELAY, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class WBClient:
+    """Долгоживущий HTTP-клиент для всех запросов к API Wildberries.
+
+    Держит одну aiohttp-сессию с keep-alive пулом соединений, лимитом соединений на хост
+    и DNS-кэшем, чтобы не платить за TCP+TLS рукопожатие на каждый запрос.
+    Создаётся при старте бота (start) и закрывается при остановке (close).
+    Все запросы проходят через лимитер частоты и повторы (request).
+    """
+
+    def __init__(self):
+        self._session = None
+        self._limiters = {}
+
+    @staticmethod
+    def _create_session() -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=WB_CONNECTION_LIMIT,
+            limit_per_host=WB_CONNECTION_LIMIT_PER_HOST,
+            ttl_dns_cache=WB_DNS_CACHE_TTL,
+            keepalive_timeout=WB_KEEPALIVE_TIMEOUT
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=ClientTimeout(total=WB_REQUEST_TIMEOUT))
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+        self._session = self._create_session()
+        logging.info("WB client session started")
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logging.info("WB client session closed")
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Ленивое создание на случай вызова вне бота (скрипты, ручной запуск)
+        if self._session is None or self._session.closed:
+            logging.warning("WB client was not started explicitly, creating session lazily")
+            self._session = self._create_session()
+        return self._session
+
+    def _limiter(self, token, host):
+        key = (token, host)
+        if key not in self._limiters:
+            per_minute, burst = WB_RATE_LIMITS.get(host, WB_DEFAULT_RATE_LIMIT)
+            self._limiters[key] = TokenBucket(per_minute / 60, burst)
+        return self._limiters[key]
+
+    @asynccontextmanager
+    async def request(self, method, url, timeout=None, attempts=WB_RETRY_ATTEMPTS, backoff=WB_RETRY_BASE_DELAY,
+                      **kwargs):
+        """Запрос через общий пул соединений; используется как `async with wb_client.request(...)`.
+
+        Перед каждой попыткой ждёт токен лимитера (токен WB + хост API). Ответы 429/5xx и сетевые
+        ошибки повторяются до attempts раз с экспоненциальной задержкой, Retry-After соблюдается.
+        После последней попытки отдаётся последний ответ (его проверяет raise_for_status вызывающего)
+        или пробрасывается последнее исключение.
+        """
+        if timeout is not None:
+            kwargs['timeout'] = ClientTimeout(total=timeout)
+        token = (kwargs.get('headers') or {}).get('Authorization', '')
+        host = URL(url).host
+        limiter = self._limiter(token, host)
+        for attempt in range(1, attempts + 1):
+            await limiter.acquire()
+            try:
+                response = await self.session.request(method, url, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == attempts:
+                    raise
+                delay = _backoff_delay(attempt, backoff)
+                logging.warning(f"WB request {method} {url} failed ({e!r}), attempt {attempt}/{attempts}, "
+                                f"retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            if response.status not in RETRY_STATUSES or attempt == attempts:
+                break
+            retry_after = _retry_after(response)
+            response.release()
+            if retry_after is not None and retry_after > WB_RETRY_MAX_DELAY:
+                raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                                  message=f"Retry-After {retry_after:.0f}s exceeds limit",
+                                                  headers=response.headers)
+            if response.status == 429 and retry_after is not None:
+                limiter.block_for(retry_after)  # Ждут все запросы этого токена к хосту
+                delay = retry_after
+            else:
+                delay = _backoff_delay(attempt, backoff)
+            logging.warning(f"WB request {method} {url} returned {response.status}, attempt {attempt}/{attempts}, "
+                            f"retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        try:
+            yield response
+        finally:
+            response.release()
+
+
+wb_client = WBClient()
+
+
 async def fetch_data(url, headers, params=None, timeout=10):
     logging.info(f"Sending GET request to {url} with params: {params}")
-    timeout = ClientTimeout(total=timeout)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        try:
-            async with session.get(url, headers=headers, params=params) as response:
-                response.raise_for_status()
-                data = await response.json()
-                logging.info(f"API response data: {data}")
-                return data
-        except aiohttp.ClientError as e:
-            logging.error(f"Request failed: {str(e)} to {url}")
-            return None
+    try:
+        async with wb_client.request("GET", url, headers=headers, params=params, timeout=timeout) as response:
+            response.raise_for_status()
+            data = await response.json()
+            logging.info(f"API response data: {data}")
+            return data
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Request failed: {str(e)} to {url}")
+        return None
 
 async def fetch_product_info(article, wb_token):
-    async with aiohttp.ClientSession(timeout=ClientTimeout(total=10)) as session:
-        url = CONTENT_URL + "/list"
-        headers = {"Authorization": f"Bearer {wb_token}", "Content-Type": "application/json"}
-        body = {"settings": {"cursor": {"limit": 100}, "filter": {"textSearch": article, "withPhoto": -1}}}
-        logging.info(f"Fetching product info for article: {article}")
-        try:
-            async with session.post(url, headers=headers, json=body) as response:
-                response.raise_for_status()
-                data = await response.json()
-                logging.info(f"Successfully fetched product info for article: {article}")
-                return data
-        except aiohttp.ClientError as e:
-            logging.error(f"Request failed: {str(e)} for article {article}")
-            return None
+    url = CONTENT_URL + "/list"
+    headers = {"Authorization": f"Bearer {wb_token}", "Content-Type": "application/json"}
+    body = {"settings": {"cursor": {"limit": 100}, "filter": {"textSearch": article, "withPhoto": -1}}}
+    logging.info(f"Fetching product info for article: {article}")
+    try:
+        async with wb_client.request("POST", url, headers=headers, json=body, timeout=10) as response:
+            response.raise_for_status()
+            data = await response.json()
+            logging.info(f"Successfully fetched product info for article: {article}")
+            return data
+    except aiohttp.ClientError as e:
+        logging.error(f"Request failed: {str(e)} for article {article}")
+        return None
 
 async def get_orders(wb_token):
     url = BASE_URL + "/orders/new"
     headers = {"Authorization": f"Bearer {wb_token}"}
     data = await fetch_data(url, headers)
-    if not data:
-        logging.error("Нет данных от API.")
-        return []
+    if data is None:
+        # Ошибка не должна выглядеть как «новых заказов нет»
+        raise WBApiError("Не удалось получить новые заказы")
     orders = data.get('orders', [])
     logging.info(f"Получено {len(orders)} новых заказов.")
     return orders
 
 
-async def get_sales_report(date_from: str, date_to: str, wb_token: str) -> dict:
+async def iter_sales_report(date_from: str, date_to: str, wb_token: str, rrdid: int = 0,
+                            limit: int = SALES_REPORT_PAGE_LIMIT):
+    """Постранично отдаёт отчёт реализации, следуя пагинации по rrdid.
+
+    Каждая страница запрашивается с повторами; если страницу так и не удалось получить,
+    выбрасывается WBApiError, чтобы потребитель не принял обрезанный отчёт за полный.
+    """
     url = "https://statistics-api.wildberries.ru/api/v5/supplier/reportDetailByPeriod"
     headers = {"Authorization": f"Bearer {wb_token}"}
-    params = {
-        "dateFrom": date_from,
-        "dateTo": date_to,
-        "limit": 100000
-    }
-
-    logging.info(f"Fetching sales report from {date_from} to {date_to}")
-    timeout = ClientTimeout(total=10)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
+    page_number = 0
+    while True:
+        params = {
+            "dateFrom": date_from,
+            "dateTo": date_to,
+            "limit": limit,
+            "rrdid": rrdid
+        }
+        logging.info(f"Fetching sales report page {page_number + 1} from {date_from} to {date_to}, rrdid {rrdid}")
         try:
-            async with session.get(url, headers=headers, params=params) as response:
-                response.raise_for_status()
-                data = await response.json()
-                logging.info(f"Received {len(data)} sales records")
-                logging.debug(f"Sample data: {data[:2]}")  # Логируем первые 2 записи для отладки
-                return data
-        except aiohttp.ClientError as e:
-            logging.error(f"Failed to fetch sales report: {e}")
-            return {}
+            async with wb_client.request("GET", url, headers=headers, params=params, timeout=SALES_REPORT_PAGE_TIMEOUT,
+                                         attempts=SALES_REPORT_PAGE_RETRIES,
+                                         backoff=SALES_REPORT_RETRY_DELAY) as response:
+                if response.status == 204:
+                    page = []  # Данных больше нет
+                else:
+                    response.raise_for_status()
+                    page = await response.json() or []
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise WBApiError(f"Sales report page with rrdid {rrdid} failed after {SALES_REPORT_PAGE_RETRIES} "
+                             f"attempts: {e}") from e
+        if not page:
+            return
+        page_number += 1
+        logging.info(f"Received {len(page)} sales records in page {page_number}")
+        logging.debug(f"Sample data: {page[:2]}")  # Логируем первые 2 записи для отладки
+        yield page
+        if len(page) < limit:
+            return
+        rrdid = page[-1].get('rrd_id', 0)
+
 
 async def get_stock_data(date_from: str, wb_token: str) -> list:
     """Получение данных по остаткам на складах."""
@@ -84,108 +236,119 @@ async def get_stock_data(date_from: str, wb_token: str) -> list:
     params = {"dateFrom": date_from}
 
     logging.info(f"Fetching stock data from {date_from}")
-    timeout = ClientTimeout(total=10)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        try:
-            async with session.get(url, headers=headers, params=params) as response:
-                response.raise_for_status()
-                data = await response.json()
-                logging.info(f"Received {len(data)} stock records")
-                logging.debug(f"Sample stock data: {data[:2]}")
-                return data
-        except aiohttp.ClientError as e:
-            logging.error(f"Failed to fetch stock data: {e}")
-            return []
-
-async def get_orders_in_transit(wb_token: str) -> list:
-    """Получение заказов в пути (сборочные задания)."""
-    url = "https://marketplace-api.wildberries.ru/api/v3/orders"
+    try:
+        async with wb_client.request("GET", url, headers=headers, params=params, timeout=10) as response:
+            response.raise_for_status()
+            data = await response.json()
+            logging.info(f"Received {len(data)} stock records")
+            logging.debug(f"Sample stock data: {data[:2]}")
+            return data
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Failed to fetch stock data: {e}")
+        raise WBApiError(f"Не удалось получить остатки: {e}") from e
+
+def _to_timestamp(value):
+    """Дата 'YYYY-MM-DD' (или готовый Unix timestamp) в Unix timestamp для marketplace API."""
+    if value is None or isinstance(value, int):
+        return value
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+async def iter_orders_in_transit(wb_token: str, date_from=None, date_to=None, limit: int = 1000):
+    """Постранично отдаёт сборочные задания, следуя курсору next.
+
+    date_from/date_to ('YYYY-MM-DD' или Unix timestamp) ограничивают период создания заданий.
+    В памяти держится только текущая страница. При ошибке выбрасывается WBApiError.
+    """
+    url = BASE_URL + "/orders"
     headers = {"Authorization": f"Bearer {wb_token}"}
-    params = {
-        "limit": 1000,  # Максимально допустимое значение
-        "next": 0       # Обязательный параметр для первого запроса
-    }
+    params = {"limit": limit, "next": 0}  # next=0 обязателен для первого запроса
+    if date_from is not None:
+        params["dateFrom"] = _to_timestamp(date_from)
+    if date_to is not None:
+        params["dateTo"] = _to_timestamp(date_to)
 
-    logging.info(f"Fetching orders in transit with params: {params}")
-    timeout = ClientTimeout(total=10)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
+    page_number = 0
+    while True:
+        logging.info(f"Fetching orders in transit with params: {params}")
         try:
-            async with session.get(url, headers=headers, params=params) as response:
+            async with wb_client.request("GET", url, headers=headers, params=params, timeout=10) as response:
                 response.raise_for_status()
                 data = await response.json()
-                orders = data.get('orders', [])
-                logging.info(f"Received {len(orders)} orders in transit")
-                logging.debug(f"Sample transit data: {orders[:2]}")
-                return orders
-        except aiohttp.ClientError as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logging.error(f"Failed to fetch orders in transit: {e}")
-            if hasattr(e, 'response') and e.response:
-                error_text = await e.response.text()
-                logging.error(f"Full error response: {error_text}")
-            return []
+            raise WBApiError(f"Не удалось получить заказы в пути: {e}") from e
+        orders = data.get('orders') or []
+        if not orders:
+            return
+        page_number += 1
+        logging.info(f"Received {len(orders)} orders in transit in page {page_number}")
+        yield orders
+        next_cursor = data.get('next')
+        if len(orders) < limit or not next_cursor or next_cursor == params["next"]:
+            return
+        params["next"] = next_cursor
 
 
-async def get_product_cards(wb_token: str) -> list:
-    """Получение полного списка карточек товаров продавца с пагинацией."""
+async def get_orders_in_transit(wb_token: str, date_from=None, date_to=None, fields=TRANSIT_FIELDS) -> list:
+    """Получение заказов в пути (сборочные задания): все страницы, в строках только нужные поля."""
+    orders = []
+    async for page in iter_orders_in_transit(wb_token, date_from, date_to):
+        orders.extend({field: order[field] for field in fields if field in order} for order in page)
+    logging.info(f"Received {len(orders)} orders in transit")
+    return orders
+
+
+async def iter_product_cards(wb_token: str, cursor=None, limit: int = 100):
+    """Постранично отдаёт карточки товаров по возрастанию updatedAt: (карточки, курсор после страницы).
+
+    cursor — {'updatedAt', 'nmID'} последней обработанной карточки; None — с начала каталога.
+    Курсор после каждой страницы можно сохранить и продолжить с него после сбоя или
+    при следующей синхронизации получить только изменённые карточки. При ошибке — WBApiError.
+    """
     url = "https://content-api.wildberries.ru/content/v2/get/cards/list"
     headers = {
         "Authorization": f"Bearer {wb_token}",
         "Content-Type": "application/json"
     }
-    all_cards = []
-    cursor = {"limit": 100}  # Максимальный лимит 100, как указано в ошибке API
+    request_cursor = {"limit": limit}  # Максимальный лимит 100
+    if cursor and cursor.get('updatedAt'):
+        request_cursor.update(updatedAt=cursor['updatedAt'], nmID=cursor['nmID'])
 
-    logging.info(f"Fetching product cards with token: {wb_token[:10]}...")
-    timeout = ClientTimeout(total=10)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        while True:
-            payload = {
-                "settings": {
-                    "cursor": cursor,
-                    "filter": {"withPhoto": -1}
-                }
+    page_number = 0
+    while True:
+        payload = {
+            "settings": {
+                "sort": {"ascending": True},
+                "cursor": request_cursor,
+                "filter": {"withPhoto": -1}
             }
-            try:
-                async with session.post(url, headers=headers, json=payload) as response:
-                    status = response.status
-                    logging.info(f"API response status: {status}")
-                    if status != 200:
-                        error_text = await response.text()
-                        logging.error(f"API error: {status} - {error_text}")
-                        break
-                    data = await response.json()
-                    cards = data.get('cards', [])
-                    logging.info(f"Received {len(cards)} product cards in this batch")
-                    if cards:
-                        logging.debug(f"Sample product cards: {cards[:2]}")
-                        all_cards.extend(cards)
-                    else:
-                        logging.warning("No cards returned in response")
-                        break
-
-                    # Обновляем курсор для следующего запроса
-                    if 'cursor' in data:
-                        next_cursor = data['cursor']
-                        cursor = {
-                            "limit": 100,
-                            "updatedAt": next_cursor.get('updatedAt'),
-                            "nmID": next_cursor.get('nmID')
-                        }
-                    else:
-                        break  # Нет курсора — конец данных
-
-                    if len(cards) < cursor['limit']:
-                        break  # Последняя страница
-
-            except aiohttp.ClientError as e:
-                logging.error(f"Failed to fetch product cards: {e}")
-                if hasattr(e, 'response') and e.response:
-                    error_text = await e.response.text()
-                    logging.error(f"Full error response: {error_text}")
-                break
-            except Exception as e:
-                logging.error(f"Unexpected error in get_product_cards: {e}", exc_info=True)
-                break
+        }
+        try:
+            async with wb_client.request("POST", url, headers=headers, json=payload,
+                                         timeout=CATALOG_PAGE_TIMEOUT) as response:
+                response.raise_for_status()
+                data = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Failed to fetch product cards after cursor {request_cursor}: {e}")
+            raise WBApiError(f"Не удалось получить карточки товаров: {e}") from e
+        cards = data.get('cards') or []
+        if not cards:
+            return
+        page_number += 1
+        next_cursor = data.get('cursor') or {}
+        logging.info(f"Received {len(cards)} product cards in page {page_number}")
+        yield cards, {'updatedAt': next_cursor.get('updatedAt'), 'nmID': next_cursor.get('nmID')}
+        if next_cursor.get('total', len(cards)) < limit or not next_cursor.get('updatedAt'):
+            return  # Последняя страница
+        request_cursor = {"limit": limit, "updatedAt": next_cursor['updatedAt'], "nmID": next_cursor['nmID']}
+
 
+async def get_product_cards(wb_token: str) -> list:
+    """Получение полного списка карточек товаров продавца с пагинацией."""
+    logging.info(f"Fetching product cards with token: {wb_token[:10]}...")
+    all_cards = []
+    async for cards, _ in iter_product_cards(wb_token):
+        all_cards.extend(cards)
     logging.info(f"Total product cards fetched: {len(all_cards)}")
-    return all_cards
\ No newline at end of file
+    return all_cards
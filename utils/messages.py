@@ -1,9 +1,12 @@
 # utils/messages.py
 from datetime import datetime
-from collections import Counter
+import io
 import pandas as pd
 import matplotlib.pyplot as plt
-from database.db import get_product
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from database.db import get_cost_map
 import os
 import logging
 
@@ -37,16 +40,22 @@ def orders_message(orders):
         )
     return f"Вот ваши новые заказы:\n" + "\n".join(order_list)
 
-def sales_report_message(metrics, user_id):
+def purchase_cost(cost_map, article):
+    """Закупочная стоимость артикула из карты get_cost_map (0.0, если товар не найден)."""
+    return cost_map.get((article or '').lower(), 0.0)
+
+
+def sales_report_message(metrics, user_id, cost_map=None):
     """Формирует текстовый отчет по продажам с уведомлением о товарах без стоимости."""
     if not metrics['sales_data']:
         return "Нет данных по продажам за указанный период.", None
 
-    missing_costs = set()
-    for sale in [s for s in metrics['sales_data'] if s.get('supplier_oper_name') == 'Продажа']:
-        product = get_product(user_id, sale.get('sa_name', ''))
-        if product and product['purchase_cost'] == 0.0:
-            missing_costs.add(sale.get('sa_name', ''))
+    if 'missing_costs' in metrics and cost_map is None:
+        missing_costs = metrics['missing_costs']
+    else:
+        if cost_map is None:
+            cost_map = metrics.get('cost_map') or get_cost_map(user_id)
+        missing_costs = missing_cost_articles(sales_frame(metrics['sales_data'], cost_map))
 
     warning = ""
     if missing_costs:
@@ -69,28 +78,125 @@ def sales_report_message(metrics, user_id):
     return text, None
 
 
-def generate_sales_chart(sales_data, stock_data, date_from, date_to):
-    if not sales_data:
+def _bucket_cost(cost_map, row):
+    """Затраты группы sales_daily в копейках по текущей стоимости: как int(cost * quantity * 100) на каждую продажу."""
+    if cost_map is None:
+        return row['cost_kop']
+    return row['sales_count'] * int(purchase_cost(cost_map, row['article']) * row['quantity'] * 100)
+
+
+def summarize_sales_daily(daily, cost_map=None):
+    """Итоги продаж по дневным агрегатам sales_daily (суммы в копейках).
+
+    Затраты пересчитываются по cost_map, если она передана, иначе берутся сохранённые при загрузке.
+    top_counts — три самых продаваемых артикула в порядке Counter.most_common по строкам отчёта.
+    """
+    totals = {'total_sales': 0, 'total_revenue': 0, 'items_sold': 0, 'total_returns': 0,
+              'total_commission': 0, 'total_delivery': 0, 'total_cost': 0}
+    counts = {}
+    for row in daily:
+        totals['total_sales'] += row['sales_count']
+        totals['total_revenue'] += row['revenue_kop']
+        totals['items_sold'] += row['sold_quantity']
+        totals['total_returns'] += row['returns']
+        totals['total_commission'] += row['commission_kop']
+        totals['total_delivery'] += row['delivery_kop']
+        totals['total_cost'] += _bucket_cost(cost_map, row)
+        if row['sales_count']:
+            # daily упорядочен по first_rrd_id, поэтому порядок артикулов совпадает с порядком их первой продажи
+            counts[row['article']] = counts.get(row['article'], 0) + row['sales_count']
+    totals['top_counts'] = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:3]
+    return totals
+
+
+def daily_profit(daily, cost_map=None):
+    """Прибыль по дням продажи (руб.) из дневных агрегатов; None, если продаж нет."""
+    by_day = {}
+    for row in daily:
+        if not row['sales_count'] or not row['sale_day']:
+            continue
+        profit = (row['revenue_kop'] - _bucket_cost(cost_map, row) - row['commission_kop']
+                  - row['sales_delivery_kop'])
+        by_day[row['sale_day']] = by_day.get(row['sale_day'], 0) + profit
+    if not by_day:
         return None
+    days = sorted(by_day)
+    return pd.DataFrame({'Прибыль': [by_day[day] / 100 for day in days]},
+                        index=[datetime.fromisoformat(day).date() for day in days])
+
+
+# Колонки отчёта реализации, из которых строится таблица продаж
+SALES_FRAME_FIELDS = ('rrd_id', 'sale_dt', 'supplier_oper_name', 'sa_name', 'subject_name', 'quantity', 'ppvz_for_pay',
+                      'retail_price_withdisc_rub', 'ppvz_sales_commission', 'delivery_rub', 'return_amount',
+                      'office_name')
+_NUMERIC_FIELDS = ('quantity', 'ppvz_for_pay', 'retail_price_withdisc_rub', 'ppvz_sales_commission', 'delivery_rub',
+                   'return_amount')
+
+
+def sales_frame(sales_data, cost_map):
+    """Строки отчёта реализации одной таблицей pandas.
+
+    Закупочная стоимость присоединяется колонкой purchase_cost, суммы переводятся в копейки
+    (*_kop) с отбрасыванием дробной части по каждой строке — так же, как int(x * 100).
+    """
+    df = pd.DataFrame(sales_data or [], columns=SALES_FRAME_FIELDS)
+    df[list(_NUMERIC_FIELDS)] = df[list(_NUMERIC_FIELDS)].apply(pd.to_numeric, errors='coerce').fillna(0)
+    df['is_sale'] = df['supplier_oper_name'].eq('Продажа')
+    df['article'] = df['sa_name'].fillna('Неизвестно')
+    df['purchase_cost'] = df['sa_name'].fillna('').astype(str).str.lower().map(cost_map).fillna(0.0)
+    df['revenue_kop'] = (df['ppvz_for_pay'] * 100).astype('int64')
+    df['commission_kop'] = (df['ppvz_sales_commission'] * 100).astype('int64')
+    df['delivery_kop'] = (df['delivery_rub'] * 100).astype('int64')
+    df['cost_kop'] = (df['purchase_cost'] * df['quantity'] * 100).astype('int64')
+    return df
+
 
-    sales = [s for s in sales_data if s.get('supplier_oper_name') == 'Продажа']
-    if not sales:
+def summarize_sales_frame(df):
+    """Итоги продаж по таблице sales_frame в том же виде, что и summarize_sales_daily."""
+    sales = df[df['is_sale']]
+    counts = sales.groupby('article', sort=False).size().sort_values(ascending=False, kind='stable')
+    return {
+        'total_sales': len(sales),
+        'total_revenue': int(sales['revenue_kop'].sum()),
+        'items_sold': int(sales['quantity'].sum()),
+        'total_returns': int(df['return_amount'].sum()),
+        'total_commission': int(sales['commission_kop'].sum()),
+        'total_delivery': int(df['delivery_kop'].sum()),
+        'total_cost': int(sales['cost_kop'].sum()),
+        # Устойчивая сортировка сохраняет порядок первой продажи при равных количествах, как Counter.most_common
+        'top_counts': [(article, int(count)) for article, count in counts.head(3).items()],
+    }
+
+
+def frame_daily_profit(df):
+    """Прибыль по дням продажи (руб.) из таблицы sales_frame; None, если продаж нет."""
+    sales = df[df['is_sale']]
+    if sales.empty:
         return None
+    days = pd.to_datetime(sales['sale_dt'], errors='coerce').dt.date
+    profit = sales['revenue_kop'] - sales['cost_kop'] - sales['commission_kop'] - sales['delivery_kop']
+    return (profit.groupby(days).sum() / 100).to_frame('Прибыль')
+
+
+def missing_cost_articles(df):
+    """Проданные артикулы без закупочной стоимости."""
+    sales = df[df['is_sale']]
+    return list(sales.loc[sales['purchase_cost'] == 0.0, 'sa_name'].fillna('').unique())
+
+
+def generate_sales_chart(sales_data, stock_data, date_from, date_to, user_id=None, cost_map=None, daily=None,
+                         frame=None):
+    if cost_map is None:
+        cost_map = get_cost_map(user_id) if user_id is not None else {}
 
-    df_sales = pd.DataFrame([{
-        'Дата': pd.to_datetime(s.get('sale_dt', '')),
-        'Выручка': s.get('ppvz_for_pay', 0),
-        'Затраты': get_product(s.get('sa_name', ''))['purchase_cost'] * s.get('quantity', 0),
-        'Комиссия': s.get('ppvz_sales_commission', 0),
-        'Доставка': s.get('delivery_rub', 0, 0)
-    } for s in sales])
-    daily_data = df_sales.groupby(df_sales['Дата'].dt.date).agg({
-        'Выручка': 'sum',
-        'Затраты': 'sum',
-        'Комиссия': 'sum',
-        'Доставка': 'sum'
-    })
-    daily_data['Прибыль'] = daily_data['Выручка'] - daily_data['Затраты'] - daily_data['Комиссия'] - daily_data['Доставка']
+    if daily is not None:
+        daily_data = daily_profit(daily, cost_map)
+    else:
+        if frame is None:
+            frame = sales_frame(sales_data, cost_map)
+        daily_data = frame_daily_profit(frame)
+    if daily_data is None:
+        return None
 
     plt.figure(figsize=(10, 5))
     plt.plot(daily_data.index, daily_data['Прибыль'], marker='o', label='Прибыль (руб.)', color='green')
@@ -100,49 +206,68 @@ def generate_sales_chart(sales_data, stock_data, date_from, date_to):
     plt.grid(True)
     plt.xticks(rotation=45)
     plt.legend(loc='upper left')
-    chart_file = f"sales_chart_{date_from}_{date_to}.png"
-    plt.savefig(chart_file, bbox_inches='tight')
+    chart = io.BytesIO()
+    plt.savefig(chart, format='png', bbox_inches='tight')
     plt.close()
-    return chart_file
+    chart.seek(0)
+    return chart
+
+
+def _append_sheet(workbook, title, columns, rows):
+    """Добавляет лист в write_only-книгу: жирная строка заголовков и строки данных."""
+    sheet = workbook.create_sheet(title)
+    header = []
+    for name in columns:
+        cell = WriteOnlyCell(sheet, value=name)
+        cell.font = Font(bold=True)
+        header.append(cell)
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
 
 
-def generate_sales_excel(sales_data, stock_data, transit_data, date_from, date_to, user_id):
-    """Генерирует Excel-файл с продажами, остатками и товарами в пути."""
+def generate_sales_excel(sales_data, stock_data, transit_data, date_from, date_to, user_id, cost_map=None, daily=None):
+    """Генерирует Excel-отчёт с продажами, остатками и товарами в пути. Возвращает (BytesIO или None, metrics).
+
+    Если переданы дневные агрегаты daily (get_sales_daily), итоги считаются по ним, а не по строкам отчёта.
+    """
     logging.info("Starting generate_sales_excel")
     if not any([sales_data, stock_data, transit_data]):
         logging.warning("No data provided to generate_sales_excel")
         return None, {}
 
     try:
-        # 1. Детализация продаж
+        # Все закупочные стоимости одним запросом вместо get_product на каждую продажу
+        if cost_map is None:
+            cost_map = get_cost_map(user_id)
+
+        # 1. Детализация продаж: одна таблица на все расчёты
         logging.info("Processing sales data")
-        sales = [sale for sale in sales_data if sale.get('supplier_oper_name') == 'Продажа'] if sales_data else []
-        detail_data = [{
-            'Дата продажи': sale.get('sale_dt', ''),
-            'Артикул продавца': sale.get('sa_name', 'Неизвестно'),
-            'Название товара': sale.get('subject_name', 'Неизвестно'),
-            'Количество': sale.get('quantity', 0),
-            'Сумма к выплате (руб.)': sale.get('ppvz_for_pay', 0),
-            'Розничная цена (руб.)': sale.get('retail_price_withdisc_rub', 0),
-            'Комиссия WB (руб.)': sale.get('ppvz_sales_commission', 0),
-            'Закупочная стоимость (руб.)': get_product(user_id, sale.get('sa_name', ''))['purchase_cost'],
-            'Склад': sale.get('office_name', '')
-        } for sale in sales]
+        df = sales_frame(sales_data, cost_map)
+        sales = df[df['is_sale']]
+        detail_df = pd.DataFrame({
+            'Дата продажи': sales['sale_dt'].fillna(''),
+            'Артикул продавца': sales['article'],
+            'Название товара': sales['subject_name'].fillna('Неизвестно'),
+            'Количество': sales['quantity'],
+            'Сумма к выплате (руб.)': sales['ppvz_for_pay'],
+            'Розничная цена (руб.)': sales['retail_price_withdisc_rub'],
+            'Комиссия WB (руб.)': sales['ppvz_sales_commission'],
+            'Закупочная стоимость (руб.)': sales['purchase_cost'],
+            'Склад': sales['office_name'].fillna('')
+        })
 
         # 2. Итоги продаж
         logging.info("Calculating summary metrics")
-        total_sales = len(sales)
-        total_revenue = sum(int(sale.get('ppvz_for_pay', 0) * 100) for sale in sales)
-        items_sold = sum(sale.get('quantity', 0) for sale in sales)
-        total_returns = sum(sale.get('return_amount', 0) for sale in sales_data) if sales_data else 0
-        total_commission = sum(int(sale.get('ppvz_sales_commission', 0) * 100) for sale in sales)
-        total_delivery = sum(int(sale.get('delivery_rub', 0) * 100) for sale in sales_data) if sales_data else 0
-        total_cost = sum(int((get_product(user_id, sale.get('sa_name', '')) or {'purchase_cost': 0})['purchase_cost'] * sale.get('quantity', 0) * 100) for sale in sales)
+        totals = summarize_sales_daily(daily, cost_map) if daily is not None else summarize_sales_frame(df)
+        total_sales, total_revenue, items_sold = totals['total_sales'], totals['total_revenue'], totals['items_sold']
+        total_returns, total_commission = totals['total_returns'], totals['total_commission']
+        total_delivery, total_cost = totals['total_delivery'], totals['total_cost']
+        top_counts = totals['top_counts']
         total_profit = total_revenue - total_cost - total_commission - total_delivery
 
         avg_sale = total_revenue / total_sales if total_sales > 0 else 0
-        product_counts = Counter(sale.get('sa_name', 'Неизвестно') for sale in sales)
-        top_products = "\nТоп-3 продаваемых товара:\n" + "\n".join(f"- {p}: {c} шт." for p, c in product_counts.most_common(3))
+        top_products = "\nТоп-3 продаваемых товара:\n" + "\n".join(f"- {p}: {c} шт." for p, c in top_counts)
 
         formatted_revenue = f"{total_revenue // 100},{total_revenue % 100:02d}"
         formatted_cost = f"{total_cost // 100},{total_cost % 100:02d}"
@@ -161,34 +286,38 @@ def generate_sales_excel(sales_data, stock_data, transit_data, date_from, date_t
 
         # 3. Остатки на складах
         logging.info("Processing stock data")
-        stock_data_formatted = [{
-            'Артикул': stock.get('supplierArticle', 'Неизвестно'),
-            'Название': stock.get('subject', 'Неизвестно'),
-            'Количество': stock.get('quantity', 0),
-            'Склад': stock.get('warehouseName', '')
-        } for stock in stock_data] if stock_data else []
+        stock_rows = [(
+            stock.get('supplierArticle', 'Неизвестно'),
+            stock.get('subject', 'Неизвестно'),
+            stock.get('quantity', 0),
+            stock.get('warehouseName', '')
+        ) for stock in stock_data] if stock_data else []
 
         # 4. Товары в пути
         logging.info("Processing transit data")
-        transit_data_formatted = [{
-            'ID заказа': transit.get('id', ''),
-            'Артикул': transit.get('article', 'Неизвестно'),
-            'Создано': transit.get('createdAt', ''),
-            'Склад': transit.get('offices', [''])[0]
-        } for transit in transit_data] if transit_data else []
-
-        # Создание Excel
-        logging.info("Generating Excel file")
-        filename = f"sales_report_{date_from}_{date_to}.xlsx"
-        with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-            if detail_data:
-                pd.DataFrame(detail_data).to_excel(writer, sheet_name='Детализация', index=False)
-            if total_sales > 0:
-                pd.DataFrame(summary_data).to_excel(writer, sheet_name='Итоги', index=False)
-            if stock_data_formatted:
-                pd.DataFrame(stock_data_formatted).to_excel(writer, sheet_name='Остатки', index=False)
-            if transit_data_formatted:
-                pd.DataFrame(transit_data_formatted).to_excel(writer, sheet_name='В пути', index=False)
+        transit_rows = [(
+            transit.get('id', ''),
+            transit.get('article', 'Неизвестно'),
+            transit.get('createdAt', ''),
+            transit.get('offices', [''])[0]
+        ) for transit in transit_data] if transit_data else []
+
+        # Создание Excel в памяти; write_only пишет строки потоком, не держа всю книгу ячейками
+        logging.info("Generating Excel workbook")
+        workbook = Workbook(write_only=True)
+        if not detail_df.empty:
+            _append_sheet(workbook, 'Детализация', detail_df.columns, detail_df.itertuples(index=False, name=None))
+        if total_sales > 0:
+            _append_sheet(workbook, 'Итоги', summary_data.keys(), zip(*summary_data.values()))
+        if stock_rows:
+            _append_sheet(workbook, 'Остатки', ('Артикул', 'Название', 'Количество', 'Склад'), stock_rows)
+        if transit_rows:
+            _append_sheet(workbook, 'В пути', ('ID заказа', 'Артикул', 'Создано', 'Склад'), transit_rows)
+        excel = None
+        if workbook.worksheets:
+            excel = io.BytesIO()
+            workbook.save(excel)
+            excel.seek(0)
 
         metrics = {
             'sales_data': sales_data,
@@ -206,10 +335,13 @@ def generate_sales_excel(sales_data, stock_data, transit_data, date_from, date_t
             'formatted_delivery': formatted_delivery,
             'formatted_profit': formatted_profit,
             'formatted_avg_sale': formatted_avg_sale,
-            'top_products': top_products
+            'top_products': top_products,
+            'missing_costs': missing_cost_articles(df),
+            'cost_map': cost_map,
+            'frame': df
         }
-        logging.info(f"Excel file generated: {filename}")
-        return filename, metrics
+        logging.info(f"Excel report generated: {excel.getbuffer().nbytes if excel else 0} bytes")
+        return excel, metrics
 
     except Exception as e:
         logging.error(f"Error in generate_sales_excel: {e}", exc_info=True)
@@ -0,0 +1,48 @@
+# utils/rate_limit.py
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов: rate токенов в секунду, не больше capacity подряд.
+
+    Ожидающие обслуживаются по очереди. block_for приостанавливает выдачу токенов,
+    когда сервис сам попросил подождать (429 Retry-After у WB, RetryAfter у Telegram).
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                wait = self.delay()
+                if not wait:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep(wait)
+
+    def delay(self):
+        """Сколько секунд ждать следующего токена (0 — токен есть); токен не расходуется."""
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def try_acquire(self):
+        """Берёт токен без ожидания; False, если его пока нет (см. delay)."""
+        if self.delay():
+            return False
+        self._tokens -= 1
+        return True
+
+    def block_for(self, seconds):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0